@@ -1,18 +1,25 @@
 from . import _version
 
-__all__ = ["norm", "infoSumOfProbes", "infoSNPN",
-           "enrich", "zscore", "bin",
+__all__ = ["norm", "norm_batch", "norm_negative_stats",
+           "norm_size_factors_append", "norm_size_factors_reference",
+           "norm_sparse",
+           "infoSumOfProbes", "infoSNPN",
+           "enrich", "enrich_sweep", "zscore", "zscore_bin_stats", "bin",
+           "bin_sweep",
            "deconv_batch", "deconv_singular", "demux",
            "link", "subjoin"
            ]
 __version__ = _version.get_versions()["version"]
 
-from q2_pepsirf.actions.bin import bin
+from q2_pepsirf.actions.bin import bin, bin_sweep
 from q2_pepsirf.actions.deconv import deconv_batch, deconv_singular
 from q2_pepsirf.actions.demux import demux
-from q2_pepsirf.actions.enrich import enrich
+from q2_pepsirf.actions.enrich import enrich, enrich_sweep
 from q2_pepsirf.actions.info import infoSumOfProbes, infoSNPN
 from q2_pepsirf.actions.link import link
-from q2_pepsirf.actions.norm import norm
+from q2_pepsirf.actions.norm import (
+    norm, norm_batch, norm_negative_stats, norm_size_factors_append,
+    norm_size_factors_reference, norm_sparse
+)
 from q2_pepsirf.actions.subjoin import subjoin
-from q2_pepsirf.actions.zscore import zscore
+from q2_pepsirf.actions.zscore import zscore, zscore_bin_stats
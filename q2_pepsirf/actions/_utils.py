@@ -0,0 +1,490 @@
+from scipy import sparse
+
+import biom
+import hashlib
+import math
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+#the cgroups of the process and the cgroup mounts holding the cpu quota,
+#v2 then v1
+PROC_SELF_CGROUP = "/proc/self/cgroup"
+CGROUP_V2_ROOT = "/sys/fs/cgroup"
+CGROUP_V1_CPU_ROOT = "/sys/fs/cgroup/cpu"
+
+# Name: _own_cgroups
+# Process: reads the cgroup v2 path and the cgroup v1 cpu controller path of
+# the process, the root cgroup is used for any not found
+# Method inputs/parameters: None
+# Method outputs/Returned: the v2 and v1 cpu cgroup paths
+# Dependencies: None
+def _own_cgroups():
+    v2 = v1 = "/"
+    try:
+        with open(PROC_SELF_CGROUP) as fh:
+            lines = fh.read().splitlines()
+    except OSError:
+        return v2, v1
+
+    #lines are hierarchy-id:controllers:path, v2 has id 0 and no controllers
+    for line in lines:
+        fields = line.split(":", 2)
+        if len(fields) != 3 or not fields[2].startswith("/"):
+            continue
+        if fields[0] == "0" and not fields[1]:
+            v2 = fields[2]
+        elif "cpu" in fields[1].split(","):
+            v1 = fields[2]
+
+    return v2, v1
+
+# Name: _cgroup_cpu_quota
+# Process: reads the cpu quota of one cgroup directory
+# Method inputs/parameters: directory, v2
+# Method outputs/Returned: the number of cpus allowed by the quota, None if
+# the cgroup is not limited or has no quota file
+# Dependencies: os
+def _cgroup_cpu_quota(directory, v2):
+    try:
+        if v2:
+            with open(os.path.join(directory, "cpu.max")) as fh:
+                quota, period = fh.read().split()[:2]
+        else:
+            with open(os.path.join(directory, "cpu.cfs_quota_us")) as fh:
+                quota = fh.read().strip()
+            with open(os.path.join(directory, "cpu.cfs_period_us")) as fh:
+                period = fh.read().strip()
+        quota = int(quota)
+        period = int(period)
+    except (OSError, ValueError):
+        #"max" (v2) means the cgroup is not limited
+        return None
+
+    #-1 (v1) means the cgroup is not limited
+    if quota <= 0 or period <= 0:
+        return None
+
+    return quota / period
+
+# Name: _cgroup_cpu_limit
+# Process: reads the cpu quota of the cgroup the process runs in, the
+# lowest quota of the cgroup and its ancestors applies
+# Method inputs/parameters: None
+# Method outputs/Returned: the number of cpus allowed by the quota, None if
+# there is no quota
+# Dependencies: math, os
+def _cgroup_cpu_limit():
+    v2_path, v1_path = _own_cgroups()
+    for root, path, v2 in (
+            (CGROUP_V2_ROOT, v2_path, True),
+            (CGROUP_V1_CPU_ROOT, v1_path, False)):
+        #without a cgroup namespace the path may not be mounted here, its
+        #ancestors up to the mount root are still checked
+        directory = os.path.normpath(root + path)
+        limits = []
+        while True:
+            limit = _cgroup_cpu_quota(directory, v2)
+            if limit is not None:
+                limits.append(limit)
+            if directory == root or not directory.startswith(root):
+                break
+            directory = os.path.dirname(directory)
+
+        if limits:
+            return max(1, math.ceil(min(limits)))
+
+    return None
+
+# Name: _available_cpus
+# Process: works out the number of cpus usable by the process from the cgroup
+# quota, the cpu affinity and the cpu count
+# Method inputs/parameters: None
+# Method outputs/Returned: the number of usable cpus
+# Dependencies: os
+def _available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        #sched_getaffinity is not available on every platform
+        cpus = os.cpu_count() or 1
+
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+
+    return max(1, cpus)
+
+# Name: _resolve_num_threads
+# Process: collects the number of threads to run with, "auto" being the
+# number of usable cpus
+# Method inputs/parameters: num_threads
+# Method outputs/Returned: the number of threads
+# Dependencies: None
+def _resolve_num_threads(num_threads):
+    if num_threads == "auto":
+        return _available_cpus()
+    return int(num_threads)
+
+# Name: _read_header
+# Process: reads the header row of a pepsirf score matrix
+# Method inputs/parameters: path
+# Method outputs/Returned: the header names, the first being the peptide
+# column header
+# Dependencies: None
+def _read_header(path):
+    with open(path) as fh:
+        return fh.readline().rstrip("\r\n").split("\t")
+
+# Name: _append_file
+# Process: appends the contents of a file to another, if it exists
+# Method inputs/parameters: path, output
+# Method outputs/Returned: None
+# Dependencies: os, shutil
+def _append_file(path, output):
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as in_fh, open(output, "ab") as fh:
+        shutil.copyfileobj(in_fh, fh)
+
+# Name: _file_sha256
+# Process: hashes the contents of a file a block at a time
+# Method inputs/parameters: path, block_size
+# Method outputs/Returned: the hex sha256 digest of the file
+# Dependencies: hashlib
+def _file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+# Name: _float_format
+# Process: collects the float format for a given output precision
+# Method inputs/parameters: precision
+# Method outputs/Returned: the float format, None for full precision
+# Dependencies: None
+def _float_format(precision):
+    #pepsirf writes scores with a fixed number of decimal places
+    if precision is None:
+        return None
+    return "%%.%df" % precision
+
+# Name: _read_scores
+# Process: reads a pepsirf score matrix into a dataframe with the peptide
+# names as the index and the sample names as the columns
+# Method inputs/parameters: path
+# Method outputs/Returned: the score matrix dataframe
+# Dependencies: pandas
+def _read_scores(path):
+    #read the first header so peptide names are never parsed as numbers
+    index_name = _read_header(path)[0]
+
+    return pd.read_csv(
+        path, sep="\t", index_col=0, dtype={index_name: str}
+    )
+
+# Name: _write_scores
+# Process: writes a score matrix dataframe in pepsirf's matrix format
+# Method inputs/parameters: dataframe, path, precision
+# Method outputs/Returned: None
+# Dependencies: pandas
+def _write_scores(dataframe, path, precision=None):
+    dataframe.index.name = "Sequence name"
+    dataframe.to_csv(
+        path, sep="\t", float_format=_float_format(precision), na_rep="nan"
+    )
+
+# Name: _select_columns
+# Process: copies the peptide column and the chosen sample columns of a score
+# matrix as text, so the copied scores are unchanged
+# Method inputs/parameters: path, positions, output
+# Method outputs/Returned: None
+# Dependencies: None
+def _select_columns(path, positions, output):
+    with open(path) as in_fh, open(output, "w") as fh:
+        for line in in_fh:
+            fields = line.rstrip("\r\n").split("\t")
+            fh.write(
+                "\t".join([fields[0], *(fields[i] for i in positions)]) + "\n"
+            )
+
+# Name: _append_columns
+# Process: writes an existing score matrix with new sample columns appended
+# to each row, the existing rows are copied as they are and peptides without
+# new scores are given nan
+# Method inputs/parameters: existing, samples, rows, output
+# Method outputs/Returned: None
+# Dependencies: None
+def _append_columns(existing, samples, rows, output):
+    missing = "\tnan" * len(samples)
+
+    with open(existing) as in_fh, open(output, "w") as fh:
+        header = in_fh.readline().rstrip("\r\n")
+        fh.write("\t".join([header, *samples]) + "\n")
+        for line in in_fh:
+            line = line.rstrip("\r\n")
+            peptide = line.split("\t", 1)[0]
+            fh.write(line + rows.get(peptide, missing) + "\n")
+
+# Name: _read_biom_table
+# Process: reads a pepsirf score matrix into a sparse biom table, a block of
+# rows at a time so the full matrix is never held densely
+# Method inputs/parameters: path, chunksize
+# Method outputs/Returned: the biom table
+# Dependencies: biom, pandas, scipy
+def _read_biom_table(path, chunksize=10000):
+    header = _read_header(path)
+    peptides = []
+    blocks = []
+
+    for chunk in pd.read_csv(
+            path, sep="\t", index_col=0, dtype={header[0]: str},
+            chunksize=chunksize):
+        peptides.extend(chunk.index)
+        blocks.append(sparse.csr_matrix(chunk.to_numpy(dtype=float)))
+
+    if blocks:
+        matrix = sparse.vstack(blocks, format="csr")
+    else:
+        matrix = sparse.csr_matrix((0, len(header) - 1))
+
+    return biom.Table(
+        matrix, observation_ids=peptides, sample_ids=header[1:]
+    )
+
+# Name: _write_biom_table
+# Process: writes a biom table in pepsirf's matrix format, densifying only
+# one block of rows at a time
+# Method inputs/parameters: table, path, precision, chunksize
+# Method outputs/Returned: None
+# Dependencies: biom, pandas
+def _write_biom_table(table, path, precision=None, chunksize=10000):
+    matrix = table.matrix_data.tocsr()
+    peptides = table.ids(axis="observation")
+
+    with open(path, "w") as fh:
+        fh.write(
+            "\t".join(["Sequence name", *table.ids(axis="sample")]) + "\n"
+        )
+        for start in range(0, matrix.shape[0], chunksize):
+            stop = start + chunksize
+            block = pd.DataFrame(
+                matrix[start:stop].toarray(), index=peptides[start:stop]
+            )
+            block.to_csv(
+                fh, sep="\t", header=False,
+                float_format=_float_format(precision), na_rep="nan"
+            )
+
+# Name: _nan_report_to_sparse
+# Process: stores a nan report as a compressed coordinate table, the probe
+# and sample names are kept once each and every nan is stored as the index
+# of its probe, sample and bin
+# Method inputs/parameters: path, output
+# Method outputs/Returned: None
+# Dependencies: numpy, pandas
+def _nan_report_to_sparse(path, output):
+    report = pd.read_csv(
+        path, sep="\t", dtype=str, na_filter=False, usecols=[0, 1, 2]
+    )
+    probe, probes = pd.factorize(report.iloc[:, 0])
+    sample, samples = pd.factorize(report.iloc[:, 1])
+
+    with open(output, "wb") as fh:
+        np.savez_compressed(
+            fh, probes=np.asarray(probes, dtype=str),
+            samples=np.asarray(samples, dtype=str),
+            probe=probe.astype(np.int32), sample=sample.astype(np.int32),
+            bin=report.iloc[:, 2].to_numpy(dtype=np.int32)
+        )
+
+# Name: _sparse_to_nan_report
+# Process: writes a compressed coordinate nan report back as pepsirf's text
+# nan report, in its original order
+# Method inputs/parameters: path, output
+# Method outputs/Returned: None
+# Dependencies: numpy
+def _sparse_to_nan_report(path, output):
+    with np.load(path) as archive:
+        probes = archive["probes"]
+        samples = archive["samples"]
+        probe = archive["probe"]
+        sample = archive["sample"]
+        bins = archive["bin"]
+
+    with open(output, "w") as fh:
+        fh.write("Probe name\tSample name\tBin number\n")
+        fh.writelines(
+            "%s\t%s\t%d\n" % (probes[row], samples[column], number)
+            for row, column, number in zip(probe, sample, bins)
+        )
+
+# Name: _read_bin_index
+# Process: reads a bins file, one tab-delimited list of peptides per line,
+# into an index of the interned peptide names, the bin of each name and the
+# names of each bin as offsets into the bin ordered members
+# Method inputs/parameters: path
+# Method outputs/Returned: the peptide names, the int32 bin of each name,
+# the offset of each bin in the members and the members
+# Dependencies: numpy, pandas
+def _read_bin_index(path):
+    with open(path) as fh:
+        bins = [
+            line.rstrip("\r\n").split("\t") for line in fh if line.strip()
+        ]
+
+    sizes = np.array([len(members) for members in bins], dtype=np.int64)
+    members, names = pd.factorize(
+        pd.Series([peptide for members in bins for peptide in members])
+    )
+
+    #a peptide listed in more than one bin is looked up in the last one
+    bin_of = np.full(len(names), -1, dtype=np.int32)
+    bin_of[members] = np.repeat(np.arange(len(bins), dtype=np.int32), sizes)
+
+    return (
+        np.asarray(names, dtype=str), bin_of,
+        np.concatenate(([0], np.cumsum(sizes))), members.astype(np.int32)
+    )
+
+# Name: _write_bin_index
+# Process: stores a bin index as a compressed numpy archive
+# Method inputs/parameters: names, bin_of, offsets, members, path
+# Method outputs/Returned: None
+# Dependencies: numpy
+def _write_bin_index(names, bin_of, offsets, members, path):
+    with open(path, "wb") as fh:
+        np.savez_compressed(
+            fh, peptides=names, bin=bin_of, offsets=offsets, members=members
+        )
+
+# Name: _load_bin_index
+# Process: loads a bin index stored as a compressed numpy archive
+# Method inputs/parameters: path
+# Method outputs/Returned: the peptide names, the bin of each name, the
+# offset of each bin in the members and the members
+# Dependencies: numpy
+def _load_bin_index(path):
+    with np.load(path) as archive:
+        return (
+            archive["peptides"], archive["bin"], archive["offsets"],
+            archive["members"]
+        )
+
+# Name: _write_bin_lines
+# Process: writes a bin index as a bins file, one tab-delimited list of
+# peptides per line
+# Method inputs/parameters: names, offsets, members, path
+# Method outputs/Returned: None
+# Dependencies: None
+def _write_bin_lines(names, offsets, members, path):
+    with open(path, "w") as fh:
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            fh.write("\t".join(names[members[start:stop]]) + "\n")
+
+# Name: _enriched_dir_to_sparse
+# Process: stores the enriched peptide files of an enrichment directory as
+# one compressed sparse boolean peptide by pair matrix, the peptide and pair
+# names are kept once each and the matrix is stored by pair as offsets into
+# the peptide indices, the failure file is kept as its lines
+# Method inputs/parameters: directory, output, failures
+# Method outputs/Returned: None
+# Dependencies: numpy, os
+def _enriched_dir_to_sparse(
+        directory, output, failures="failedEnrichment.txt"):
+
+    files = sorted(
+        name for name in os.listdir(directory)
+        if name.endswith(".txt") and name != failures
+    )
+
+    rows = {}
+    indices = []
+    indptr = [0]
+    for name in files:
+        with open(os.path.join(directory, name)) as fh:
+            for line in fh:
+                peptide = line.strip()
+                if peptide:
+                    indices.append(rows.setdefault(peptide, len(rows)))
+        indptr.append(len(indices))
+
+    failed = []
+    if os.path.exists(os.path.join(directory, failures)):
+        with open(os.path.join(directory, failures)) as fh:
+            failed = [line.rstrip("\r\n") for line in fh]
+
+    with open(output, "wb") as fh:
+        np.savez_compressed(
+            fh, peptides=np.array(list(rows), dtype=str),
+            files=np.array(files, dtype=str),
+            indices=np.array(indices, dtype=np.int32),
+            indptr=np.array(indptr, dtype=np.int64),
+            failures=np.array(failed, dtype=str)
+        )
+
+# Name: _sparse_to_enriched_dir
+# Process: writes a sparse enrichment matrix back as one enriched peptide
+# file per pair and the failure file
+# Method inputs/parameters: path, directory, failures
+# Method outputs/Returned: None
+# Dependencies: numpy, os
+def _sparse_to_enriched_dir(path, directory, failures="failedEnrichment.txt"):
+    with np.load(path) as archive:
+        peptides = archive["peptides"]
+        files = archive["files"]
+        indices = archive["indices"]
+        indptr = archive["indptr"]
+        failed = archive["failures"]
+
+    for name, start, stop in zip(files, indptr[:-1], indptr[1:]):
+        with open(os.path.join(directory, name), "w") as fh:
+            fh.writelines(
+                peptide + "\n" for peptide in peptides[indices[start:stop]]
+            )
+
+    with open(os.path.join(directory, failures), "w") as fh:
+        fh.writelines(line + "\n" for line in failed)
+
+# Name: _count_peptides
+# Process: counts the peptides of an enriched peptide file, one per non-blank
+# line
+# Method inputs/parameters: path
+# Method outputs/Returned: the number of peptides
+# Dependencies: None
+def _count_peptides(path):
+    with open(path) as fh:
+        return sum(1 for line in fh if line.strip())
+
+# Name: _write_enriched_manifest
+# Process: writes the manifest of an enrichment directory, the pair name,
+# file name, peptide count, sha256 checksum and byte size of every enriched
+# peptide file
+# Method inputs/parameters: directory, failures, manifest
+# Method outputs/Returned: the manifest rows
+# Dependencies: os
+def _write_enriched_manifest(
+        directory, failures="failedEnrichment.txt", manifest="manifest.tsv"):
+
+    rows = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".txt") or name == failures:
+            continue
+
+        path = os.path.join(directory, name)
+        count = _count_peptides(path)
+        #the pair name is the file name without the enriched suffix
+        rows.append(
+            (name[:-len(".txt")].rsplit("_", 1)[0], name, count,
+             _file_sha256(path), os.path.getsize(path))
+        )
+
+    with open(os.path.join(directory, manifest), "w") as fh:
+        fh.write("Pair\tFile\tPeptides\tChecksum\tBytes\n")
+        fh.writelines("%s\t%s\t%d\t%s\t%d\n" % row for row in rows)
+
+    return rows
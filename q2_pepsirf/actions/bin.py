@@ -1,23 +1,222 @@
+from q2_pepsirf.actions._utils import _file_sha256, _read_scores
 from q2_pepsirf.format_types import (
-    PeptideBinFormat, PepsirfContingencyTSVFormat
+    BinSweepSummaryFormat, PeptideBinFormat, PepsirfContingencyTSVFormat
 )
+from typing import Dict
 
+import hashlib
+import inspect
+import numpy as np
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
 
+# Name: _round_scores
+# Process: rounds scores to the nearest 1/10^x for a rounding factor x,
+# halves being rounded away from zero as pepsirf does
+# Method inputs/parameters: values, round_to
+# Method outputs/Returned: the rounded scores
+# Dependencies: numpy
+def _round_scores(values, round_to):
+    factor = 10.0 ** round_to
+    return np.sign(values) * np.floor(np.abs(values) * factor + 0.5) / factor
+
+# Name: _pack_bins
+# Process: walks the groups of tied peptides from the lowest to the highest
+# score, adding groups to a bin until it holds at least bin_size peptides, a
+# last bin with too few peptides is merged into the one before it
+# Method inputs/parameters: sizes, bin_size
+# Method outputs/Returned: the index of the first group of each bin, with
+# the number of groups appended
+# Dependencies: None
+def _pack_bins(sizes, bin_size):
+    starts = [0]
+    members = 0
+    for group, size in enumerate(sizes):
+        members += size
+        if members >= bin_size:
+            starts.append(group + 1)
+            members = 0
+
+    #merge a short last bin into the previous bin
+    if members:
+        if len(starts) > 1:
+            starts[-1] = len(sizes)
+        else:
+            starts.append(len(sizes))
+
+    return starts
+
+# Name: _rank_peptides
+# Process: sums the scores of every peptide across the samples and sorts the
+# peptides by their totals, rounding keeps this order so the sort can be
+# shared by any rounding factor
+# Method inputs/parameters: scores
+# Method outputs/Returned: the sorted peptide names and their sorted totals
+# Dependencies: numpy, pandas
+def _rank_peptides(scores):
+    scores = _read_scores(scores)
+    totals = scores.to_numpy(dtype=float).sum(axis=1)
+    order = np.argsort(totals, kind="stable")
+
+    return scores.index.to_numpy()[order], totals[order]
+
+# Name: _write_bins
+# Process: groups the sorted peptides with tied rounded totals, packs the
+# groups into bins and writes one tab-delimited bin per line
+# Method inputs/parameters: peptides, totals, bin_size, round_to, bin_output
+# Method outputs/Returned: the number of peptides in each bin
+# Dependencies: numpy
+def _write_bins(peptides, totals, bin_size, round_to, bin_output):
+    ranked = _round_scores(totals, round_to)
+    breaks = np.flatnonzero(ranked[1:] != ranked[:-1]) + 1
+    offsets = np.concatenate(([0], breaks, [len(ranked)]))
+
+    starts = _pack_bins(np.diff(offsets), bin_size)
+    sizes = []
+    with open(bin_output, "w") as fh:
+        for start, stop in zip(starts[:-1], starts[1:]):
+            members = peptides[offsets[start]:offsets[stop]]
+            sizes.append(len(members))
+            fh.write("\t".join(members) + "\n")
+
+    return sizes
+
+# Name: _bin_numpy
+# Process: bins peptides in process by their rounded scores summed across
+# the samples
+# Method inputs/parameters: scores, bin_size, round_to, bin_output
+# Method outputs/Returned: None
+# Dependencies: numpy
+def _bin_numpy(scores, bin_size, round_to, bin_output):
+    peptides, totals = _rank_peptides(scores)
+    _write_bins(peptides, totals, bin_size, round_to, bin_output)
+
+# Name: _run_bin
+# Process: bins the peptides of a score matrix file with pepsirf's bin
+# module or in process
+# Method inputs/parameters: scores, bin_size, round_to, engine, bin_output,
+# outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: subprocess, tempfile
+def _run_bin(
+        scores, bin_size, round_to, engine, bin_output, outfile,
+        pepsirf_binary):
+
+    if engine == "numpy":
+        _bin_numpy(scores, bin_size, round_to, bin_output)
+        return
+
+    #open temp file to work in
+    with tempfile.TemporaryDirectory() as tempdir:
+
+        #collect command line
+        cmd = (
+            "%s bin -s %s -b %s"
+            " -r %s -o %s"
+            % (
+                pepsirf_binary, scores, str(bin_size),
+                str(round_to), bin_output
+            )
+        )
+
+        #add outfile to command
+        cmd += " >> %s" % outfile
+
+        #run the collected command
+        subprocess.run(cmd, shell=True, check=True)
+
+# Name: _engine_version
+# Process: collects what identifies the binning implementation, the hash
+# of the pepsirf binary or, for the numpy engine, a hash of the source of
+# the functions that bin the peptides
+# Method inputs/parameters: engine, pepsirf_binary
+# Method outputs/Returned: the engine version string
+# Dependencies: hashlib, inspect, shutil
+def _engine_version(engine, pepsirf_binary):
+    if engine == "numpy":
+        digest = hashlib.sha256()
+        for function in (_round_scores, _pack_bins, _rank_peptides,
+                         _write_bins, _bin_numpy):
+            digest.update(inspect.getsource(function).encode())
+        return "numpy-%s" % digest.hexdigest()
+
+    binary = shutil.which(pepsirf_binary)
+    if binary is None:
+        return "pepsirf-%s" % pepsirf_binary
+    return "pepsirf-%s" % _file_sha256(binary)
+
+# Name: _bin_cache_key
+# Process: collects the cache key of a binning, a hash of the score matrix
+# contents, the binning parameters and the engine version
+# Method inputs/parameters: scores, bin_size, round_to, engine,
+# pepsirf_binary
+# Method outputs/Returned: the hex sha256 cache key
+# Dependencies: hashlib
+def _bin_cache_key(scores, bin_size, round_to, engine, pepsirf_binary):
+    key = "\t".join([
+        _file_sha256(scores), str(bin_size), str(round_to),
+        _engine_version(engine, pepsirf_binary)
+    ])
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# Name: _cached_bin
+# Process: copies the bins of a previous identical binning from the cache,
+# or bins the peptides and stores the bins in the cache, the cache entry is
+# written to a temporary file and renamed so readers never see part of it
+# Method inputs/parameters: scores, bin_size, round_to, engine, bin_output,
+# cache_dir, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: os, shutil, tempfile
+def _cached_bin(
+        scores, bin_size, round_to, engine, bin_output, cache_dir, outfile,
+        pepsirf_binary):
+
+    key = _bin_cache_key(scores, bin_size, round_to, engine, pepsirf_binary)
+    cached = os.path.join(cache_dir, "%s.bins" % key)
+
+    if os.path.isfile(cached):
+        shutil.copyfile(cached, bin_output)
+        return
+
+    _run_bin(
+        scores, bin_size, round_to, engine, bin_output, outfile,
+        pepsirf_binary
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, partial = tempfile.mkstemp(dir=cache_dir, suffix=".partial")
+    os.close(handle)
+    try:
+        shutil.copyfile(bin_output, partial)
+
+        #mkstemp creates the file readable only by its owner, the entry is
+        #given the usual permissions so the cache can be shared
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(partial, 0o666 & ~umask)
+
+        os.replace(partial, cached)
+    except BaseException:
+        os.remove(partial)
+        raise
+
 # Name: bin
 # Process: runs PepSIRF's bin module
 # Method inputs/parameters: scores, allow_other_normalization,
-# bin_size, round_to, outfile, pepsirf_binary
+# bin_size, round_to, engine, cache_dir, outfile, pepsirf_binary
 # Method outputs/Returned: bin file
-# Dependencies: subprocess, os, tempfile, sys
+# Dependencies: os, sys
 def bin(
         scores: PepsirfContingencyTSVFormat,
         allow_other_normalization: bool = False,
         bin_size: int = 300,
         round_to: int = 0,
+        engine: str = "pepsirf",
+        cache_dir: str = None,
         outfile: str = "./bin.out",
         pepsirf_binary: str = "pepsirf") -> PeptideBinFormat:
     
@@ -32,25 +231,63 @@ def bin(
     if os.path.isfile(pepsirf_binary):
         pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
 
-    #open temp file to work in
-    with tempfile.TemporaryDirectory() as tempdir:
-
-        #collect command line
-        cmd = (
-            "%s bin -s %s -b %s"
-            " -r %s -o %s"
-            % (
-                pepsirf_binary, str(scores), str(bin_size),
-                str(round_to), str(bin_out)
-            )
+    if cache_dir:
+        _cached_bin(
+            str(scores), bin_size, round_to, engine, str(bin_out),
+            os.path.abspath(cache_dir), outfile, pepsirf_binary
+        )
+    else:
+        _run_bin(
+            str(scores), bin_size, round_to, engine, str(bin_out), outfile,
+            pepsirf_binary
         )
 
-        #add outfile to command
-        cmd += " >> %s" % outfile
+    #return the bin outputs as qza's
+    return bin_out
 
-        #run the collected command
-        subprocess.run(cmd, shell=True, check=True)
+# Name: bin_sweep
+# Process: bins the peptides once for every combination of bin size and
+# rounding factor, summing and sorting the peptide scores only once,
+# repeated bin sizes and rounding factors are only tried once
+# Method inputs/parameters: scores, bin_sizes, round_tos
+# Method outputs/Returned: the bin file of each combination, keyed by
+# "<bin_size>_<round_to>", and a summary of the bins of each combination
+# Dependencies: numpy
+def bin_sweep(
+        scores: PepsirfContingencyTSVFormat,
+        bin_sizes: list,
+        round_tos: list
+    ) -> (Dict[str, PeptideBinFormat], BinSweepSummaryFormat):
+
+    summary = BinSweepSummaryFormat()
+    peptides, totals = _rank_peptides(str(scores))
+
+    #a repeated value would give the same collection key twice
+    bin_sizes = list(dict.fromkeys(bin_sizes))
+    round_tos = list(dict.fromkeys(round_tos))
+
+    bin_outputs = {}
+    with summary.open() as fh:
+        fh.write(
+            "Bin size\tRound to\tNumber of bins\tMin peptides\t"
+            "Median peptides\tMean peptides\tMax peptides\n"
+        )
+        for bin_size in bin_sizes:
+            for round_to in round_tos:
+                bin_out = PeptideBinFormat()
+                sizes = _write_bins(
+                    peptides, totals, bin_size, round_to, str(bin_out)
+                )
+                bin_outputs["%d_%d" % (bin_size, round_to)] = bin_out
 
-        #return the bin outputs as qza's
-        return bin_out
+                #an empty score matrix gives no bins
+                count = len(sizes)
+                sizes = np.asarray(sizes or [0])
+                fh.write(
+                    "%d\t%d\t%d\t%d\t%g\t%g\t%d\n" % (
+                        bin_size, round_to, count, sizes.min(),
+                        np.median(sizes), sizes.mean(), sizes.max()
+                    )
+                )
 
+    return bin_outputs, summary
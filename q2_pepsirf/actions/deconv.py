@@ -1,8 +1,9 @@
 from distutils.dir_util import copy_tree
+from q2_pepsirf.actions._utils import _count_peptides
 from q2_pepsirf.format_types import(
     PeptideIDListFmt, PepsirfLinkTSVFormat, PepsirfDMPFormat,
     EnrichedPeptideDirFmt, PepsirfDeconvSingularFormat, ScorePerRoundDirFmt,
-    PepsirfDeconvBatchDirFmt, PeptideAssignMapDirFmt
+    PepsirfDeconvBatchDirFmt, PeptideAssignMapDirFmt, _read_enriched_manifest
 )
 
 import os
@@ -149,8 +150,25 @@ def deconv_batch(
         temp_enriched = os.path.join(tempdir, "enriched")
         os.mkdir(temp_enriched)
 
-        for name, fmt in enriched_dir.pairwise.iter_views(PeptideIDListFmt):
-            qiime2.util.duplicate(str(fmt), os.path.join(temp_enriched, name))
+        #only the pairs with enriched peptides are copied, the manifest
+        #has their counts, otherwise empty files are skipped by size and
+        #only the others are opened to be counted
+        manifest = _read_enriched_manifest(enriched)
+        if manifest is not None:
+            pairs = [
+                (name, os.path.join(enriched, name))
+                for _, name, count, _, _ in manifest if count
+            ]
+        else:
+            pairs = [
+                (str(name), str(fmt))
+                for name, fmt in enriched_dir.pairwise.iter_views(
+                    PeptideIDListFmt)
+                if os.path.getsize(str(fmt)) and _count_peptides(str(fmt))
+            ]
+
+        for name, path in pairs:
+            qiime2.util.duplicate(path, os.path.join(temp_enriched, name))
 
         #start command with required/defualt parameters
         cmd = collect_cmd(
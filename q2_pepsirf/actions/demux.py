@@ -1,3 +1,4 @@
+from q2_pepsirf.actions._utils import _resolve_num_threads
 from q2_pepsirf.format_types import (
     PepsirfContingencyTSVFormat, PepsirfDemuxDiagnosticFormat,
     PepsirfDemuxFastqFmt, PepsirfDemuxFifFmt, PepsirfDemuxIndexFmt,
@@ -42,6 +43,8 @@ def demux(
     raw_data = PepsirfContingencyTSVFormat()
     diagnostic_data = PepsirfDemuxDiagnosticFormat()
 
+    num_threads = _resolve_num_threads(num_threads)
+
     #collect absolute filepaths for input files and binary if it is a file
     input_r1 = "%s" % str(input_r1)
     input_r2 = "%s" % str(input_r2)
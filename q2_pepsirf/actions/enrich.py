@@ -1,55 +1,451 @@
+from concurrent.futures import ProcessPoolExecutor
 from posixpath import abspath
+from q2_pepsirf.actions._utils import (
+    _append_file, _read_scores, _resolve_num_threads,
+    _write_enriched_manifest
+)
 from q2_pepsirf.format_types import(
-    EnrichedPeptideDirFmt, PepsirfContingencyTSVFormat, EnrichThreshFileFormat
+    EnrichedPeptideDirFmt, PepsirfContingencyTSVFormat, EnrichThreshFileFormat,
+    EnrichSweepCountsFormat
 )
 
 import csv
 import itertools
+import numpy as np
 import os
 import qiime2
+import random
 import subprocess
 import tempfile
 
-# Name: _make_pairs_file
-# Process: function used to take source metadata and create pairs files
-# Method inputs/parameters: column, outpath
-# Method outputs/Returned: the pairs result
-# Dependencies: itertools
-def _make_pairs_file(column, outpath):
+# Name: _source_groups
+# Process: groups the sample names of source metadata by source
+# Method inputs/parameters: column
+# Method outputs/Returned: an iterator over the sample names of each group
+# Dependencies: None
+def _source_groups(column):
     series = column.to_series()
-    pairs = {k: v.index for k,v in series.groupby(series)}
-    result = []
+    for _, group in series.groupby(series):
+        yield list(group.index)
+
+# Name: _sampled_pairs
+# Process: yields a random sample of the pairs of a group without building
+# every pair, the chosen pair numbers are sorted so the pairs keep the
+# order of itertools.combinations
+# Method inputs/parameters: ids, count, rng
+# Method outputs/Returned: an iterator over the sampled pairs
+# Dependencies: None
+def _sampled_pairs(ids, count, rng):
+    total = len(ids) * (len(ids) - 1) // 2
+    chosen = iter(sorted(rng.sample(range(total), count)))
+
+    #walk the pairs row by row, the pairs of row a start at first
+    number = next(chosen, None)
+    first = 0
+    for a in range(len(ids) - 1):
+        last = first + len(ids) - 1 - a
+        while number is not None and number < last:
+            yield ids[a], ids[a + 1 + number - first]
+            number = next(chosen, None)
+        first = last
 
-    for _, ids in pairs.items():
-        result.append(list(itertools.combinations(ids, 2)))
+# Name: _iter_pairs
+# Process: yields every pair of samples with the same source, a random
+# sample of at most max_pairs_per_group pairs is taken of larger groups
+# Method inputs/parameters: column, max_pairs_per_group, seed
+# Method outputs/Returned: an iterator over the pairs
+# Dependencies: itertools, random
+def _iter_pairs(column, max_pairs_per_group=None, seed=None):
+    rng = random.Random(seed)
+    for ids in _source_groups(column):
+        total = len(ids) * (len(ids) - 1) // 2
+        if max_pairs_per_group and total > max_pairs_per_group:
+            yield from _sampled_pairs(ids, max_pairs_per_group, rng)
+        else:
+            yield from itertools.combinations(ids, 2)
 
+# Name: _write_sets
+# Process: writes sample sets as tab-delimited lines, in buffered blocks
+# Method inputs/parameters: sets, outpath, buffer_size
+# Method outputs/Returned: the number of sets written
+# Dependencies: itertools
+def _write_sets(sets, outpath, buffer_size=10000):
+    lines = ("\t".join(names) + "\n" for names in sets)
+    count = 0
     with open(outpath, "w") as fh:
-        for pair in result:
-            for a, b in pair:
-                fh.write(a + "\t" + b + "\n")
+        while True:
+            block = list(itertools.islice(lines, buffer_size))
+            if not block:
+                return count
+            fh.writelines(block)
+            count += len(block)
 
-    return result
+# Name: _make_pairs_file
+# Process: function used to take source metadata and create pairs files
+# Method inputs/parameters: column, outpath, max_pairs_per_group, seed
+# Method outputs/Returned: the number of pairs
+# Dependencies: None
+def _make_pairs_file(column, outpath, max_pairs_per_group=None, seed=None):
+    return _write_sets(
+        _iter_pairs(column, max_pairs_per_group, seed), outpath
+    )
 
 # Name: _make_reps_file
 # Process: function used to take source metadata and create replicates files
 # Method inputs/parameters: column, outpath
-# Method outputs/Returned: None
-# Dependencies: itertools
+# Method outputs/Returned: the number of replicate sets
+# Dependencies: None
 def _make_reps_file(column, outpath):
-    series = column.to_series()
-    pairs = {k: v.index for k,v in series.groupby(series)}
-    with open( outpath, 'w' ) as of:
-        for _, reps in pairs.items():
-            for rep in reps[:len(reps) - 1]:
-                of.write( rep + "\t" )
-            of.write( reps[ len(reps) - 1] )
-            of.write( "\n" )
+    return _write_sets(_source_groups(column), outpath)
+
+# Name: _parse_thresholds
+# Process: reads an enrichment threshold, either one threshold that every
+# replicate must meet or a comma-delimited lower and higher threshold, where
+# every replicate must meet the lower and at least one the higher
+# Method inputs/parameters: thresholds
+# Method outputs/Returned: the lower and higher thresholds
+# Dependencies: None
+def _parse_thresholds(thresholds):
+    values = [float(value) for value in str(thresholds).split(",")]
+    return min(values), max(values)
+
+# Name: _read_replicate_sets
+# Process: reads the tab-delimited replicate names of each sample set
+# from a pairs or replicates file
+# Method inputs/parameters: pairs_file
+# Method outputs/Returned: the list of replicate name tuples
+# Dependencies: None
+def _read_replicate_sets(pairs_file):
+    with open(pairs_file) as fh:
+        return [
+            tuple(line.rstrip("\r\n").split("\t"))
+            for line in fh if line.strip()
+        ]
+
+# Name: _enriched_filename
+# Process: collects the enriched peptide file name of a sample set, only
+# the first three names are kept when truncating
+# Method inputs/parameters: names, suffix, truncate
+# Method outputs/Returned: the file name
+# Dependencies: None
+def _enriched_filename(names, suffix, truncate):
+    if truncate and len(names) > 3:
+        names = [*names[:3], "%dmore" % (len(names) - 3)]
+    return "~".join(names) + suffix
+
+# Name: _read_threshold_matrix
+# Process: reads the scores of the given samples from a threshold matrix,
+# aligned to the given peptides when provided
+# Method inputs/parameters: path, samples, peptides
+# Method outputs/Returned: the peptide names and the score array, with one
+# column per sample
+# Dependencies: pandas
+def _read_threshold_matrix(path, samples, peptides=None):
+    scores = _read_scores(path)
+
+    missing = [sample for sample in samples if sample not in scores]
+    if missing:
+        raise ValueError(
+            "Samples not found in %s: %s" % (path, ", ".join(missing))
+        )
+
+    #peptides missing from a matrix are never enriched
+    if peptides is None:
+        peptides = scores.index
+    values = scores.reindex(index=peptides, columns=samples).to_numpy(
+        dtype=float
+    )
+
+    return peptides, values
+
+# Name: _enrich_masks
+# Process: reads every threshold matrix once and evaluates its thresholds
+# for all samples at once, the lower thresholds of all matrices are
+# combined into one mask and the higher thresholds are kept per matrix
+# Method inputs/parameters: thresh_file, samples
+# Method outputs/Returned: the peptide names, the combined lower threshold
+# mask and the higher threshold masks, with one column per sample
+# Dependencies: csv, numpy
+def _enrich_masks(thresh_file, samples):
+    #blank and comment lines are skipped
+    with open(thresh_file, newline="") as fh:
+        rows = [
+            row for row in csv.reader(fh, delimiter="\t")
+            if row and row[0].strip() and not row[0].startswith("#")
+        ]
+
+    if not rows:
+        raise ValueError(
+            "The threshold file %s has no threshold matrices." % thresh_file
+        )
+
+    peptides = None
+    low_mask = None
+    high_masks = []
+    for path, thresholds in rows:
+        low, high = _parse_thresholds(thresholds)
+        peptides, values = _read_threshold_matrix(path, samples, peptides)
+
+        mask = values >= low
+        low_mask = mask if low_mask is None else low_mask & mask
+        if high > low:
+            high_masks.append(values >= high)
+
+    return peptides.to_numpy(), low_mask, high_masks
+
+# Name: _raw_failures
+# Process: finds the samples whose total raw count is below the constraint
+# Method inputs/parameters: raw_scores, raw_constraint
+# Method outputs/Returned: the set of failing sample names
+# Dependencies: pandas
+def _raw_failures(raw_scores, raw_constraint):
+    if not raw_scores or not raw_constraint:
+        return set()
+
+    totals = _read_scores(raw_scores).sum(axis=0)
+    return set(totals.index[totals < raw_constraint])
+
+# Name: _split_raw_failures
+# Process: separates the sample sets with a replicate below the raw count
+# constraint from the sets to evaluate
+# Method inputs/parameters: sets, raw_scores, raw_constraint
+# Method outputs/Returned: the sets to evaluate, the failures of the others
+# with their reason and the names of the samples to evaluate
+# Dependencies: None
+def _split_raw_failures(sets, raw_scores, raw_constraint):
+    failed = _raw_failures(raw_scores, raw_constraint)
+    failures = [
+        (names, "Raw read count threshold") for names in sets
+        if failed.intersection(names)
+    ]
+    sets = [names for names in sets if not failed.intersection(names)]
+    samples = list(dict.fromkeys(name for names in sets for name in names))
+
+    return sets, failures, samples
+
+# Name: _iter_set_blocks
+# Process: groups the sample sets by size and yields blocks of them with
+# the sample columns of their replicates, blocks are sized so a gathered
+# block of peptide by set by replicate values of itemsize bytes each stays
+# within block_bytes
+# Method inputs/parameters: sets, samples, peptide_count, itemsize,
+# block_bytes
+# Method outputs/Returned: an iterator over the blocks of sets and their
+# set by replicate column arrays
+# Dependencies: numpy
+def _iter_set_blocks(
+        sets, samples, peptide_count, itemsize=1, block_bytes=64 << 20):
+    column = {sample: position for position, sample in enumerate(samples)}
+    by_size = {}
+    for names in sets:
+        by_size.setdefault(len(names), []).append(names)
+
+    for size, size_sets in by_size.items():
+        columns = np.array(
+            [[column[name] for name in names] for names in size_sets]
+        )
+        block = max(
+            1, block_bytes // max(1, peptide_count * size * itemsize)
+        )
+        for start in range(0, len(size_sets), block):
+            yield size_sets[start:start + block], columns[start:start + block]
+
+# Name: _write_enriched_block
+# Process: writes the enriched peptides of a block of sample sets, one file
+# per set, and collects the sets without enriched peptides as failures
+# Method inputs/parameters: peptides, block, enriched, failures, truncate,
+# out_suffix, output_dir
+# Method outputs/Returned: None
+# Dependencies: numpy, os
+def _write_enriched_block(
+        peptides, block, enriched, failures, truncate, out_suffix,
+        output_dir):
+
+    for names, mask in zip(block, enriched.T):
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            failures.append((names, "No enriched peptides"))
+            continue
+
+        path = os.path.join(
+            output_dir, _enriched_filename(names, out_suffix, truncate)
+        )
+        with open(path, "w") as fh:
+            fh.write("\n".join(peptides[rows]) + "\n")
+
+# Name: _write_failures
+# Process: writes the replicate names and reason of every failed sample set
+# Method inputs/parameters: failures, path
+# Method outputs/Returned: None
+# Dependencies: None
+def _write_failures(failures, path):
+    with open(path, "w") as fh:
+        fh.writelines(
+            "%s\t%s\n" % (",".join(names), reason)
+            for names, reason in failures
+        )
+
+# Name: _enrich_numpy
+# Process: finds the enriched peptides of every sample set in process, the
+# threshold masks of all sample sets of the same size are combined in
+# blocks with vectorized boolean reductions over the replicates
+# Method inputs/parameters: thresh_file, pairs_file, raw_scores,
+# raw_constraint, enrichment_failure, truncate, out_suffix, output_dir
+# Method outputs/Returned: None
+# Dependencies: os
+def _enrich_numpy(
+        thresh_file, pairs_file, raw_scores, raw_constraint,
+        enrichment_failure, truncate, out_suffix, output_dir):
+
+    sets, failures, samples = _split_raw_failures(
+        _read_replicate_sets(pairs_file), raw_scores, raw_constraint
+    )
+    peptides, low_mask, high_masks = _enrich_masks(thresh_file, samples)
+
+    for block, cols in _iter_set_blocks(
+            sets, samples, len(peptides), low_mask.itemsize):
+        enriched = low_mask[:, cols].all(axis=2)
+        for high_mask in high_masks:
+            enriched &= high_mask[:, cols].any(axis=2)
+
+        _write_enriched_block(
+            peptides, block, enriched, failures, truncate, out_suffix,
+            output_dir
+        )
+
+    if enrichment_failure:
+        _write_failures(
+            failures, os.path.join(output_dir, enrichment_failure)
+        )
+
+# Name: _run_enrich
+# Process: finds the enriched peptides of the sample sets of a pairs file
+# with pepsirf's enrich module or in process
+# Method inputs/parameters: thresh_file, pairs_file, raw_scores,
+# raw_constraint, enrichment_failure, truncate, out_suffix, engine,
+# output_dir, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: subprocess
+def _run_enrich(
+        thresh_file, pairs_file, raw_scores, raw_constraint,
+        enrichment_failure, truncate, out_suffix, engine, output_dir,
+        outfile, pepsirf_binary):
+
+    if engine == "numpy":
+        _enrich_numpy(
+            thresh_file, pairs_file, raw_scores, raw_constraint,
+            enrichment_failure, truncate, out_suffix, output_dir
+        )
+        return
+
+    #put together command
+    cmd = (
+        "%s enrich -t %s -s %s -x %s -o %s"
+        % (
+            pepsirf_binary, thresh_file, pairs_file,
+            out_suffix, output_dir
+        )
+    )
+
+    #add optionals to command
+    if raw_scores:
+        cmd += " -r %s" % raw_scores
+    if raw_constraint:
+        cmd += " --raw_score_constraint %s" % str(raw_constraint)
+    if enrichment_failure:
+        cmd += " -f %s" % enrichment_failure
+    if truncate:
+        cmd += " --output_filename_truncate"
+
+    #add outfile to command
+    cmd += " >> %s" % outfile
+
+    #run command
+    s = subprocess.run(cmd, shell=True, check=True)
+
+    #check exit code and raise error if not 0
+    if s.returncode > 0:
+        raise ValueError(
+            "Enrich module failed. Exit code %s." % str(s.returncode)
+        )
+
+# Name: _run_enrich_shards
+# Process: splits the sample sets of a pairs file into up to jobs shards,
+# finds the enriched peptides of each shard concurrently in a process pool
+# and merges the enriched peptide files, failures and logs of the shards
+# Method inputs/parameters: thresh_file, pairs_file, raw_scores,
+# raw_constraint, enrichment_failure, truncate, out_suffix, engine,
+# output_dir, jobs, tempdir, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: concurrent.futures, os
+def _run_enrich_shards(
+        thresh_file, pairs_file, raw_scores, raw_constraint,
+        enrichment_failure, truncate, out_suffix, engine, output_dir, jobs,
+        tempdir, outfile, pepsirf_binary):
+
+    with open(pairs_file) as fh:
+        lines = [line for line in fh if line.strip()]
+
+    jobs = min(jobs, len(lines))
+    if jobs <= 1:
+        _run_enrich(
+            thresh_file, pairs_file, raw_scores, raw_constraint,
+            enrichment_failure, truncate, out_suffix, engine, output_dir,
+            outfile, pepsirf_binary
+        )
+        return
+
+    #split the sample sets into contiguous shards of nearly equal size
+    shards = []
+    for shard in range(jobs):
+        shard_dir = os.path.join(tempdir, "shard%d" % shard)
+        os.makedirs(os.path.join(shard_dir, "out"))
+        with open(os.path.join(shard_dir, "pairs.tsv"), "w") as fh:
+            fh.writelines(
+                lines[len(lines) * shard // jobs:
+                      len(lines) * (shard + 1) // jobs]
+            )
+        shards.append(shard_dir)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                _run_enrich, thresh_file,
+                os.path.join(shard_dir, "pairs.tsv"), raw_scores,
+                raw_constraint, enrichment_failure, truncate, out_suffix,
+                engine, os.path.join(shard_dir, "out"),
+                os.path.join(shard_dir, "enrich.out"), pepsirf_binary
+            )
+            for shard_dir in shards
+        ]
+
+        #raise the first failure, if any
+        for future in futures:
+            future.result()
+
+    #merge the shards in order
+    for shard_dir in shards:
+        shard_out = os.path.join(shard_dir, "out")
+        for name in os.listdir(shard_out):
+            if name != enrichment_failure:
+                os.replace(
+                    os.path.join(shard_out, name),
+                    os.path.join(output_dir, name)
+                )
+
+        if enrichment_failure:
+            _append_file(
+                os.path.join(shard_out, enrichment_failure),
+                os.path.join(output_dir, enrichment_failure)
+            )
+        _append_file(os.path.join(shard_dir, "enrich.out"), outfile)
 
 # Name: enrich
 # Process: runs pepsirf's enrich module
 # Method inputs/parameters: source, flex_reps, thresh_file, zscores, col_sum,
 # exact_z_thresh, exact_cs_thresh, raw_scores, raw_constraint,
-# enrichment_failure, truncate, outfile, pepsirf_binary
+# enrichment_failure, truncate, max_pairs_per_group, seed, engine, jobs,
+# outfile, pepsirf_binary
 # Method outputs/Returned: the enriched directory
 # Dependencies: subprocess, os, csv, tempfile
 def enrich(
@@ -64,6 +460,10 @@ def enrich(
         raw_constraint: int = None,
         enrichment_failure: bool = False,
         truncate: bool = False,
+        max_pairs_per_group: int = None,
+        seed: int = None,
+        engine: str = "pepsirf",
+        jobs: int = 1,
         outfile: str = "./enrich.out",
         pepsirf_binary: str = "pepsirf") -> EnrichedPeptideDirFmt:
 
@@ -83,7 +483,9 @@ def enrich(
             _make_reps_file(source, tmp_pairs_file)
         else: # otherwise, assume infer pairs
             tmp_pairs_file = os.path.join(tempdir, "pairs.tsv")
-            _make_pairs_file(source, tmp_pairs_file)
+            _make_pairs_file(
+                source, tmp_pairs_file, max_pairs_per_group, seed
+            )
 
         #set up default threshold files and peptide enrichment suffix
         tmp_thresh_file = os.path.join(tempdir, "tempThreshFile.tsv")
@@ -99,37 +501,16 @@ def enrich(
         else:
             tmp_thresh_file = str(thresh_file)
 
-        #put together command
-        cmd = (
-            "%s enrich -t %s -s %s -x %s -o %s"
-            % (
-                pepsirf_binary, tmp_thresh_file, tmp_pairs_file,
-                out_suffix, str(dir_fmt_output)
-            )
-        )
-
-        #add optionals to command
-        if raw_scores:
-            cmd += " -r %s" % str(raw_scores)
-        if raw_constraint:
-            cmd += " --raw_score_constraint %s" % str(raw_constraint)
         if enrichment_failure:
             enrichment_failure = "failedEnrichment.txt"
-            cmd += " -f %s" % enrichment_failure
-        if truncate:
-            cmd += " --output_filename_truncate"
-
-        #add outfile to command
-        cmd += " >> %s" % outfile
-
-        #run command
-        s = subprocess.run(cmd, shell=True, check=True)
 
-        #check exit code and raise error if not 0
-        if s.returncode > 0:
-            raise ValueError(
-                "Enrich module failed. Exit code %s." % str(s.returncode)
-            )
+        _run_enrich_shards(
+            tmp_thresh_file, tmp_pairs_file,
+            str(raw_scores) if raw_scores else None, raw_constraint,
+            enrichment_failure, truncate, out_suffix, engine,
+            str(dir_fmt_output), _resolve_num_threads(jobs), tempdir,
+            outfile, pepsirf_binary
+        )
 
         # check if failure file exists
         failed = (dir_fmt_output.path/"failedEnrichment.txt")
@@ -139,10 +520,129 @@ def enrich(
             with failed.open("w") as fh:
                 pass
 
-        # check if the only file is failed
-        # dir_fmt_output.path.iterdir() or #... .path.glob('*_enriched.txt')
-        if len(list(dir_fmt_output.path.iterdir())) <= 1:
+        # index the enriched peptide files and check that any were found
+        manifest = _write_enriched_manifest(str(dir_fmt_output))
+        if not any(count for _, _, count, _, _ in manifest):
             raise ValueError("No enriched peptides.")
 
         #return enrich directory as qza
         return dir_fmt_output
+
+# Name: _threshold_sweep_masks
+# Process: evaluates every threshold of a sweep against the lowest and
+# highest replicate score of each sample set
+# Method inputs/parameters: lowest, highest, thresholds
+# Method outputs/Returned: the peptide by set mask of each threshold
+# Dependencies: numpy
+def _threshold_sweep_masks(lowest, highest, thresholds):
+    masks = []
+    for low, high in thresholds:
+        masks.append((lowest >= low) & (highest >= high))
+    return masks
+
+# Name: enrich_sweep
+# Process: evaluates a grid of z score and col-sum thresholds in process,
+# reading the matrices once and taking the lowest and highest replicate
+# score of each sample set once for all thresholds
+# Method inputs/parameters: source, zscores, col_sum, z_thresholds,
+# cs_thresholds, flex_reps, raw_scores, raw_constraint, selected_z_thresh,
+# selected_cs_thresh, truncate, max_pairs_per_group, seed
+# Method outputs/Returned: the enriched peptide counts of every sample set
+# and threshold combination, and the enriched directory of the selected
+# combination
+# Dependencies: itertools, numpy, os
+def enrich_sweep(
+        source: qiime2.CategoricalMetadataColumn,
+        zscores: PepsirfContingencyTSVFormat,
+        col_sum: PepsirfContingencyTSVFormat,
+        z_thresholds: list,
+        cs_thresholds: list,
+        flex_reps: bool = False,
+        raw_scores: PepsirfContingencyTSVFormat = None,
+        raw_constraint: int = None,
+        selected_z_thresh: str = None,
+        selected_cs_thresh: str = None,
+        truncate: bool = False,
+        max_pairs_per_group: int = None,
+        seed: int = None
+    ) -> (EnrichSweepCountsFormat, EnrichedPeptideDirFmt):
+
+    counts = EnrichSweepCountsFormat()
+    dir_fmt_output = EnrichedPeptideDirFmt()
+    out_suffix = "_enriched.txt"
+
+    if not z_thresholds or not cs_thresholds:
+        raise ValueError(
+            "At least one z score and one column sum threshold are needed."
+        )
+
+    #the first thresholds of the grid are selected by default
+    if selected_z_thresh is None:
+        selected_z_thresh = z_thresholds[0]
+    if selected_cs_thresh is None:
+        selected_cs_thresh = cs_thresholds[0]
+
+    if flex_reps:
+        sets = [tuple(names) for names in _source_groups(source)]
+    else:
+        sets = list(_iter_pairs(source, max_pairs_per_group, seed))
+    sets, failures, samples = _split_raw_failures(
+        sets, str(raw_scores) if raw_scores else None, raw_constraint
+    )
+
+    peptides, z_values = _read_threshold_matrix(str(zscores), samples)
+    _, cs_values = _read_threshold_matrix(str(col_sum), samples, peptides)
+    peptides = peptides.to_numpy()
+
+    z_grid = [_parse_thresholds(thresholds) for thresholds in z_thresholds]
+    cs_grid = [_parse_thresholds(thresholds) for thresholds in cs_thresholds]
+    selected = (
+        _parse_thresholds(selected_z_thresh),
+        _parse_thresholds(selected_cs_thresh)
+    )
+
+    with counts.open() as fh:
+        fh.write(
+            "Sample set\tZ threshold\tCol-sum threshold\t"
+            "Enriched peptides\n"
+        )
+        #the z score and column sum blocks are gathered together
+        itemsize = z_values.itemsize + cs_values.itemsize
+        for block, cols in _iter_set_blocks(
+                sets, samples, len(peptides), itemsize):
+            #a nan replicate makes the lowest and highest scores nan
+            z_block = z_values[:, cols]
+            cs_block = cs_values[:, cols]
+            z_lowest, z_highest = z_block.min(axis=2), z_block.max(axis=2)
+            cs_lowest, cs_highest = cs_block.min(axis=2), cs_block.max(axis=2)
+
+            z_masks = _threshold_sweep_masks(z_lowest, z_highest, z_grid)
+            cs_masks = _threshold_sweep_masks(cs_lowest, cs_highest, cs_grid)
+            names = ["~".join(names) for names in block]
+            for (z_thresh, z_mask), (cs_thresh, cs_mask) in (
+                    itertools.product(
+                        zip(z_thresholds, z_masks),
+                        zip(cs_thresholds, cs_masks))):
+                enriched = (z_mask & cs_mask).sum(axis=0)
+                fh.writelines(
+                    "%s\t%s\t%s\t%d\n" % (name, z_thresh, cs_thresh, count)
+                    for name, count in zip(names, enriched)
+                )
+
+            z_mask, = _threshold_sweep_masks(
+                z_lowest, z_highest, [selected[0]]
+            )
+            cs_mask, = _threshold_sweep_masks(
+                cs_lowest, cs_highest, [selected[1]]
+            )
+            _write_enriched_block(
+                peptides, block, z_mask & cs_mask, failures, truncate,
+                out_suffix, str(dir_fmt_output)
+            )
+
+    _write_failures(
+        failures, str(dir_fmt_output.path / "failedEnrichment.txt")
+    )
+    _write_enriched_manifest(str(dir_fmt_output))
+
+    return counts, dir_fmt_output
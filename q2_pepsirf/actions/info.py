@@ -1,28 +1,84 @@
+from q2_pepsirf.actions._utils import _read_header
 from q2_pepsirf.format_types import(
     PepsirfInfoSNPNDirFmt, PepsirfInfoSNPNFormat, PepsirfInfoSumOfProbesFmt,
     PepsirfContingencyTSVFormat, InfoSNPN
 )
 
+import numpy as np
 import os
 import pandas as pd
 import qiime2
 import subprocess
 import tempfile
 
+# Name: _write_sample_names
+# Process: writes the sample names of a score matrix, read from its header
+# Method inputs/parameters: input, output
+# Method outputs/Returned: None
+# Dependencies: None
+def _write_sample_names(input, output):
+    with open(output, "w") as fh:
+        fh.writelines(name + "\n" for name in _read_header(input)[1:])
+
+# Name: _write_probe_names
+# Process: writes the probe names of a score matrix, reading only the first
+# column of each row
+# Method inputs/parameters: input, output
+# Method outputs/Returned: None
+# Dependencies: None
+def _write_probe_names(input, output):
+    with open(input) as in_fh, open(output, "w") as fh:
+        next(in_fh, None)
+        fh.writelines(
+            line.split("\t", 1)[0].rstrip("\r\n") + "\n"
+            for line in in_fh if line.strip()
+        )
+
+# Name: _write_sum_of_probes
+# Process: writes the sum of the probe scores of every sample of a score
+# matrix, summing blocks of rows as they are read
+# Method inputs/parameters: input, output, chunksize
+# Method outputs/Returned: None
+# Dependencies: numpy, pandas
+def _write_sum_of_probes(input, output, chunksize=10000):
+    samples = _read_header(input)[1:]
+    sums = np.zeros(len(samples))
+
+    for chunk in pd.read_csv(
+            input, sep="\t", usecols=range(1, len(samples) + 1),
+            dtype=float, chunksize=chunksize):
+        sums += chunk.to_numpy().sum(axis=0)
+
+    with open(output, "w") as fh:
+        fh.write("Sample name\tSum of probe scores\n")
+        fh.writelines(
+            "%s\t%.2f\n" % (sample, total)
+            for sample, total in zip(samples, sums)
+        )
+
 # Name: infoSNPN
 # Process: runs pepsirf's info sample/probes module
-# Method inputs/parameters: input, get, outfile, pepsirf_binary
+# Method inputs/parameters: input, get, engine, outfile, pepsirf_binary
 # Method outputs/Returned: the samples names or probes names tsv
 # Dependencies: subprocess, os, tempfile
 def infoSNPN(
         input: PepsirfContingencyTSVFormat,
         get: str,
+        engine: str = "pepsirf",
         outfile: str = "./info.out",
         pepsirf_binary: str = "pepsirf") -> PepsirfInfoSNPNFormat:
 
     #create PepsirfInfoSNPNFormat output
     snpn_out = PepsirfInfoSNPNFormat()
 
+    #the names are read directly from the matrix without pepsirf
+    if engine == "numpy":
+        if get == "samples":
+            _write_sample_names(str(input), str(snpn_out))
+        elif get == "probes":
+            _write_probe_names(str(input), str(snpn_out))
+        return snpn_out
+
     #get absolute file path to pepsirf if it is a file
     if os.path.isfile(pepsirf_binary):
         pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
@@ -52,17 +108,22 @@ def infoSNPN(
         
 # Name: infoSumOfProbes
 # Process: runs pepsirf's info sum of probes module
-# Method inputs/parameters: input, outfile, pepsirf_binary
+# Method inputs/parameters: input, engine, outfile, pepsirf_binary
 # Method outputs/Returned: the sum of probes names tsv
 # Dependencies: subprocess, os, tempfile
 def infoSumOfProbes(
         input: PepsirfContingencyTSVFormat,
+        engine: str = "pepsirf",
         outfile: str = "./info.out",
         pepsirf_binary: str = "pepsirf") -> PepsirfInfoSumOfProbesFmt:
 
     #create PepsirfInfoSumOfProbesFmt output
     sum_of_probes_out = PepsirfInfoSumOfProbesFmt()
 
+    if engine == "numpy":
+        _write_sum_of_probes(str(input), str(sum_of_probes_out))
+        return sum_of_probes_out
+
     #get absolute file path to pepsirf if it is a file
     if os.path.isfile(pepsirf_binary):
         pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
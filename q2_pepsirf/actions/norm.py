@@ -1,26 +1,422 @@
-from q2_pepsirf.format_types import PepsirfContingencyTSVFormat
+from concurrent.futures import ProcessPoolExecutor
+from q2_pepsirf.actions._utils import (
+    _append_columns, _append_file, _float_format, _read_header, _read_scores,
+    _resolve_num_threads, _write_scores
+)
+from q2_pepsirf.format_types import (
+    NegativeControlStatsFormat, PepsirfContingencyTSVFormat,
+    SizeFactorsReferenceFormat
+)
+from scipy import sparse
+from typing import Dict
 
+import biom
+import numpy as np
 import os
+import pandas as pd
 import qiime2
 import subprocess
 import tempfile
 
+# Name: _select_negatives
+# Process: selects the negative control samples by prefix and/or by name,
+# every sample of a negative control matrix is used otherwise
+# Method inputs/parameters: columns, negative_id, negative_names,
+# negative_control
+# Method outputs/Returned: a boolean mask of the negative control samples
+# Dependencies: numpy
+def _select_negatives(columns, negative_id, negative_names, negative_control):
+    if negative_id or negative_names:
+        selected = np.zeros(len(columns), dtype=bool)
+        if negative_id:
+            selected |= columns.str.startswith(negative_id)
+        if negative_names:
+            selected |= columns.isin(negative_names)
+    elif negative_control:
+        selected = np.ones(len(columns), dtype=bool)
+    else:
+        raise ValueError(
+            "A negative control matrix, negative_id or negative_names must be"
+            " provided for this normalization approach."
+        )
+
+    if not selected.any():
+        raise ValueError("No negative control samples were found.")
+
+    return selected
+
+# Name: _negative_means
+# Process: collects the mean score of each peptide across the negative
+# control samples
+# Method inputs/parameters: scores, negative_control, negative_id,
+# negative_names
+# Method outputs/Returned: the per peptide negative control means
+# Dependencies: numpy
+def _negative_means(scores, negative_control, negative_id, negative_names):
+    #negative controls come from their own matrix if one is given
+    if negative_control:
+        controls = _read_scores(negative_control)
+    else:
+        controls = scores
+
+    selected = _select_negatives(
+        controls.columns, negative_id, negative_names, negative_control
+    )
+
+    return controls.loc[:, selected].mean(axis=1).reindex(scores.index)
+
+# Name: _normalize_values
+# Process: applies a normalization approach to a block of scores given the
+# per sample factors or the per peptide negative control means
+# Method inputs/parameters: values, normalize_approach, factors, means
+# Method outputs/Returned: the normalized scores
+# Dependencies: numpy
+def _normalize_values(values, normalize_approach, factors=None, means=None):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if normalize_approach in ("col_sum", "size_factors"):
+            return values / factors
+
+        means = np.asarray(means, dtype=float)[:, np.newaxis]
+        if normalize_approach == "diff":
+            return values - means
+        elif normalize_approach == "ratio":
+            return values / means
+        elif normalize_approach == "diff_ratio":
+            return (values - means) / means
+
+    raise ValueError("Unknown normalization approach: %s" % normalize_approach)
+
+# Name: _geo_means
+# Process: calculates the geometric mean score of each peptide, peptides
+# with a score of zero in any sample have a geometric mean of 0
+# Method inputs/parameters: values
+# Method outputs/Returned: the per peptide geometric means
+# Dependencies: numpy
+def _geo_means(values):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.exp(np.log(values).mean(axis=1))
+
+# Name: _size_factors
+# Process: calculates the size factor of each sample (Anders and Huber 2010),
+# peptides with a geometric mean of 0 are left out of the reference
+# Method inputs/parameters: values, geo_means
+# Method outputs/Returned: the per sample size factors
+# Dependencies: numpy
+def _size_factors(values, geo_means=None):
+    if geo_means is None:
+        geo_means = _geo_means(values)
+    usable = geo_means > 0
+
+    ratios = values[usable] / geo_means[usable][:, np.newaxis]
+    return np.median(ratios, axis=0)
+
+# Name: _sparse_size_factors
+# Process: calculates the size factor of each sample from a sparse matrix,
+# only peptides without a zero score are dense and used as the reference
+# Method inputs/parameters: matrix
+# Method outputs/Returned: the per sample size factors
+# Dependencies: numpy
+def _sparse_size_factors(matrix):
+    #peptides with a score of zero in any sample have a geometric mean of 0
+    usable = np.diff(matrix.tocsr().indptr) == matrix.shape[1]
+    reference = matrix.tocsr()[usable].toarray()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        geo_means = np.exp(np.log(reference).mean(axis=1))
+        return np.median(reference / geo_means[:, np.newaxis], axis=0)
+
+# Name: _norm_sparse_table
+# Process: normalizes the sparse matrix of a biom table, zero scores stay
+# zero for both col_sum and size_factors so the output stays sparse
+# Method inputs/parameters: table, normalize_approach, precision
+# Method outputs/Returned: the normalized biom table
+# Dependencies: biom, numpy, scipy
+def _norm_sparse_table(table, normalize_approach, precision):
+    matrix = table.matrix_data.tocsc().astype(float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if normalize_approach == "col_sum":
+            scale = 1000000 / np.asarray(matrix.sum(axis=0)).ravel()
+        elif normalize_approach == "size_factors":
+            scale = 1 / _sparse_size_factors(matrix)
+        else:
+            raise ValueError(
+                "Unknown sparse normalization approach: %s"
+                % normalize_approach
+            )
+
+    #scale each sample column and round the stored scores only
+    normed = (matrix @ sparse.diags(scale)).tocsr()
+    normed.data = np.round(normed.data, precision)
+    normed.eliminate_zeros()
+
+    return biom.Table(
+        normed, observation_ids=table.ids(axis="observation"),
+        sample_ids=table.ids(axis="sample")
+    )
+
+# Name: _norm_numpy
+# Process: normalizes a score matrix in process with vectorized operations
+# Method inputs/parameters: peptide_scores, tsv_output, normalize_approach,
+# negative_control, negative_id, negative_names, precision
+# Method outputs/Returned: None
+# Dependencies: numpy, pandas
+def _norm_numpy(
+        peptide_scores, tsv_output, normalize_approach,
+        negative_control, negative_id, negative_names, precision):
+
+    scores = _read_scores(peptide_scores)
+    values = scores.to_numpy(dtype=float)
+    factors = None
+    means = None
+
+    if normalize_approach == "col_sum":
+        factors = values.sum(axis=0) / 1000000
+    elif normalize_approach == "size_factors":
+        factors = _size_factors(values)
+    else:
+        means = _negative_means(
+            scores, negative_control, negative_id, negative_names
+        )
+
+    normed = _normalize_values(values, normalize_approach, factors, means)
+    normed = pd.DataFrame(normed, index=scores.index, columns=scores.columns)
+    _write_scores(normed, tsv_output, precision)
+
+# Name: _block_size
+# Process: collects how many rows (or columns) of a given length fit in the
+# memory limit, leaving room for the parsing overhead of pandas
+# Method inputs/parameters: max_memory, length
+# Method outputs/Returned: the block size
+# Dependencies: None
+def _block_size(max_memory, length):
+    return max(1, (max_memory * 1024 * 1024) // (max(length, 1) * 8 * 4))
+
+# Name: _iter_row_blocks
+# Process: reads a score matrix a block of peptides at a time
+# Method inputs/parameters: path, rows, usecols
+# Method outputs/Returned: an iterator of score dataframes
+# Dependencies: pandas
+def _iter_row_blocks(path, rows, usecols=None):
+    header = _read_header(path)
+    return pd.read_csv(
+        path, sep="\t", index_col=0, dtype={header[0]: str},
+        usecols=usecols, chunksize=rows
+    )
+
+# Name: _streaming_geo_means
+# Process: calculates the geometric mean score of each peptide a block of
+# peptides at a time
+# Method inputs/parameters: path, rows
+# Method outputs/Returned: the per peptide geometric means
+# Dependencies: pandas
+def _streaming_geo_means(path, rows):
+    geo_means = [
+        pd.Series(_geo_means(block.to_numpy(dtype=float)), index=block.index)
+        for block in _iter_row_blocks(path, rows)
+    ]
+
+    return pd.concat(geo_means) if geo_means else pd.Series(dtype=float)
+
+# Name: _streaming_size_factors
+# Process: calculates the size factors with a single read of the matrix, the
+# ratio of every score to the geometric mean of its peptide only needs the
+# peptide's row, so the ratios are cached in a binary file a block of
+# peptides at a time and the median ratios are then taken a block of samples
+# at a time from the cache
+# Method inputs/parameters: path, header, rows, max_memory
+# Method outputs/Returned: the per sample size factors
+# Dependencies: numpy, os, tempfile
+def _streaming_size_factors(path, header, rows, max_memory):
+    samples = len(header) - 1
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        cache = os.path.join(tempdir, "ratios.f8")
+        usable = 0
+        with open(cache, "wb") as fh:
+            for block in _iter_row_blocks(path, rows):
+                values = block.to_numpy(dtype=float)
+                geo_means = _geo_means(values)
+                #peptides with a geometric mean of 0 are left out
+                keep = geo_means > 0
+                ratios = values[keep] / geo_means[keep][:, np.newaxis]
+                ratios.tofile(fh)
+                usable += int(keep.sum())
+
+        if not usable:
+            return np.full(samples, np.nan)
+
+        #every peptide is needed for a median so take whole sample columns
+        ratios = np.memmap(
+            cache, dtype=float, mode="r", shape=(usable, samples)
+        )
+        columns = _block_size(max_memory, usable)
+        factors = np.concatenate([
+            np.median(ratios[:, start:start + columns], axis=0)
+            for start in range(0, samples, columns)
+        ])
+        del ratios
+
+    return factors
+
+# Name: _streaming_negative_means
+# Process: collects the mean score of each peptide across the negative
+# control samples a block of peptides at a time
+# Method inputs/parameters: peptide_scores, negative_control, negative_id,
+# negative_names, max_memory
+# Method outputs/Returned: the per peptide negative control means
+# Dependencies: numpy, pandas
+def _streaming_negative_means(
+        peptide_scores, negative_control, negative_id, negative_names,
+        max_memory):
+
+    path = negative_control if negative_control else peptide_scores
+    header = _read_header(path)
+    selected = _select_negatives(
+        pd.Index(header[1:]), negative_id, negative_names, negative_control
+    )
+
+    #only read the peptide names and the negative control columns
+    usecols = [0, *(np.flatnonzero(selected) + 1)]
+    rows = _block_size(max_memory, len(usecols))
+    means = [
+        block.mean(axis=1)
+        for block in _iter_row_blocks(path, rows, usecols)
+    ]
+
+    return pd.concat(means)
+
+# Name: _norm_streaming
+# Process: normalizes a score matrix without loading it into memory, the
+# factors or negative control means are collected first and then the
+# matrix is normalized and written a block of peptides at a time
+# Method inputs/parameters: peptide_scores, tsv_output, normalize_approach,
+# negative_control, negative_id, negative_names, precision, max_memory
+# Method outputs/Returned: None
+# Dependencies: numpy, pandas
+def _norm_streaming(
+        peptide_scores, tsv_output, normalize_approach,
+        negative_control, negative_id, negative_names, precision,
+        max_memory):
+
+    header = _read_header(peptide_scores)
+    rows = _block_size(max_memory, len(header) - 1)
+    factors = None
+    means = None
+
+    if normalize_approach == "col_sum":
+        sums = np.zeros(len(header) - 1)
+        for block in _iter_row_blocks(peptide_scores, rows):
+            sums += block.to_numpy(dtype=float).sum(axis=0)
+        factors = sums / 1000000
+    elif normalize_approach == "size_factors":
+        factors = _streaming_size_factors(
+            peptide_scores, header, rows, max_memory
+        )
+    else:
+        means = _streaming_negative_means(
+            peptide_scores, negative_control, negative_id, negative_names,
+            max_memory
+        )
+
+    with open(tsv_output, "w") as fh:
+        fh.write("\t".join(["Sequence name", *header[1:]]) + "\n")
+        for block in _iter_row_blocks(peptide_scores, rows):
+            block_means = None
+            if means is not None:
+                block_means = means.reindex(block.index)
+
+            normed = _normalize_values(
+                block.to_numpy(dtype=float), normalize_approach,
+                factors, block_means
+            )
+            pd.DataFrame(normed, index=block.index).to_csv(
+                fh, sep="\t", header=False,
+                float_format=_float_format(precision), na_rep="nan"
+            )
+
+# Name: _run_norm
+# Process: normalizes a score matrix file into an output file with the
+# chosen engine
+# Method inputs/parameters: peptide_scores, tsv_output, normalize_approach,
+# negative_control, negative_id, negative_names, negative_stats, precision,
+# engine, max_memory, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: subprocess, tempfile
+def _run_norm(
+        peptide_scores, tsv_output, normalize_approach, negative_control,
+        negative_id, negative_names, negative_stats, precision, engine,
+        max_memory, outfile, pepsirf_binary):
+
+    #the negative control means are a single column matrix, so they stand in
+    #for the negative control matrix without re-scanning the controls
+    if negative_stats:
+        negative_control = negative_stats
+        negative_id = None
+        negative_names = None
+
+    #normalize in process without starting pepsirf
+    if engine == "numpy":
+        _norm_numpy(
+            peptide_scores, tsv_output, normalize_approach,
+            negative_control, negative_id, negative_names, precision
+        )
+        return
+
+    #normalize in blocks so memory is bound by max_memory
+    if engine == "streaming":
+        _norm_streaming(
+            peptide_scores, tsv_output, normalize_approach,
+            negative_control, negative_id, negative_names, precision,
+            max_memory
+        )
+        return
+
+    #create a temp directory to run pepsirf in
+    with tempfile.TemporaryDirectory() as tempdir:
+        #start command with required/defualt parameters
+        cmd = (
+            "%s norm -a %s --precision %s -o %s -p %s"
+            % (
+                pepsirf_binary, normalize_approach, str(precision),
+                tsv_output, peptide_scores
+            )
+        )
+
+        #check if optional parameters are inputted and add to command
+        if negative_control:
+            cmd += " --negative_control %s" % str(negative_control)
+        if negative_id:
+            cmd += " -s %s" % negative_id
+        if negative_names:
+            cmd += " -n %s" % ",".join(negative_names)
+
+    #add outfile to command
+    cmd += " >> %s" % outfile
+
+    #run command in the command line
+    subprocess.run(cmd, shell=True, check=True)
+
 # Name: norm
 # Process: runs pepsirf's norm module
 # Method inputs/parameters: peptide_scores, normalize_approach, negative_control,
-# negative_id, negative_names, precision, outfile, pepsirf_binary
+# negative_id, negative_names, negative_stats, precision, engine, max_memory,
+# outfile, pepsirf_binary
 # Method outputs/Returned: the norm output tsv
-# Dependencies: subprocess, os, tempfile
+# Dependencies: os
 def norm(
         peptide_scores: PepsirfContingencyTSVFormat,
         normalize_approach: str = "col_sum",
         negative_control: PepsirfContingencyTSVFormat = None,
         negative_id: str = None,
         negative_names: list = None,
+        negative_stats: NegativeControlStatsFormat = None,
         precision: int = 2,
+        engine: str = "pepsirf",
+        max_memory: int = 1024,
         outfile: str = "./norm.out",
         pepsirf_binary: str = "pepsirf") -> PepsirfContingencyTSVFormat:
-    
+
     #collect filepath for TSVFormat
     tsv_output = PepsirfContingencyTSVFormat()
 
@@ -29,34 +425,212 @@ def norm(
         peptide_scores = "%s" % os.path.abspath(str(peptide_scores))
     if negative_control:
         negative_control = "%s" % os.path.abspath(str(negative_control))
+    if negative_stats:
+        negative_stats = "%s" % os.path.abspath(str(negative_stats))
     if os.path.isfile(pepsirf_binary):
         pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
 
-    #create a temp directory to run pepsirf in
-    with tempfile.TemporaryDirectory() as tempdir:
-        #start command with required/defualt parameters
-        cmd = (
-            "%s norm -a %s --precision %s -o %s -p %s"
-            % (
-                pepsirf_binary, normalize_approach, str(precision),
-                str(tsv_output), str(peptide_scores)
+    _run_norm(
+        peptide_scores, str(tsv_output), normalize_approach, negative_control,
+        negative_id, negative_names, negative_stats, precision, engine,
+        max_memory, outfile, pepsirf_binary
+    )
+
+    #return norm output
+    return tsv_output
+
+# Name: norm_batch
+# Process: normalizes a collection of score matrices, running up to jobs
+# normalizations at a time in a process pool, each normalization logs to its
+# own file and the logs are appended to outfile in input order
+# Method inputs/parameters: peptide_scores, normalize_approach,
+# negative_control, negative_id, negative_names, negative_stats, precision,
+# engine, max_memory, jobs, outfile, pepsirf_binary
+# Method outputs/Returned: the norm output tsv of each input, by input name
+# Dependencies: concurrent.futures, os, tempfile
+def norm_batch(
+        peptide_scores: Dict[str, PepsirfContingencyTSVFormat],
+        normalize_approach: str = "col_sum",
+        negative_control: PepsirfContingencyTSVFormat = None,
+        negative_id: str = None,
+        negative_names: list = None,
+        negative_stats: NegativeControlStatsFormat = None,
+        precision: int = 2,
+        engine: str = "pepsirf",
+        max_memory: int = 1024,
+        jobs: int = 1,
+        outfile: str = "./norm.out",
+        pepsirf_binary: str = "pepsirf"
+        ) -> Dict[str, PepsirfContingencyTSVFormat]:
+
+    #collections are given as a dict, lists are keyed by position
+    if not isinstance(peptide_scores, dict):
+        peptide_scores = {
+            str(key): table for key, table in enumerate(peptide_scores)
+        }
+
+    #collect absolute filepaths for shared inputs and binary if it is a file
+    if negative_control:
+        negative_control = "%s" % os.path.abspath(str(negative_control))
+    if negative_stats:
+        negative_stats = "%s" % os.path.abspath(str(negative_stats))
+    if os.path.isfile(pepsirf_binary):
+        pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
+
+    tsv_outputs = {
+        key: PepsirfContingencyTSVFormat() for key in peptide_scores
+    }
+
+    workers = max(
+        1, min(_resolve_num_threads(jobs), len(peptide_scores))
+    )
+    with tempfile.TemporaryDirectory() as tempdir, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        logs = {
+            key: os.path.join(tempdir, "norm%d.out" % position)
+            for position, key in enumerate(peptide_scores)
+        }
+        futures = [
+            executor.submit(
+                _run_norm, os.path.abspath(str(table)),
+                str(tsv_outputs[key]), normalize_approach, negative_control,
+                negative_id, negative_names, negative_stats, precision,
+                engine, max_memory, logs[key], pepsirf_binary
             )
+            for key, table in peptide_scores.items()
+        ]
+
+        #raise the first failure, if any
+        for future in futures:
+            future.result()
+
+        #concurrent runs do not share a log, so it is not interleaved
+        for log in logs.values():
+            _append_file(log, outfile)
+
+    return tsv_outputs
+
+# Name: norm_negative_stats
+# Process: collects the mean score of each peptide across the negative
+# controls once, for reuse by norm's diff, ratio and diff_ratio approaches
+# Method inputs/parameters: negative_control, negative_id, negative_names,
+# max_memory
+# Method outputs/Returned: the negative control statistics tsv
+# Dependencies: os
+def norm_negative_stats(
+        negative_control: PepsirfContingencyTSVFormat,
+        negative_id: str = None,
+        negative_names: list = None,
+        max_memory: int = 1024) -> NegativeControlStatsFormat:
+
+    stats_output = NegativeControlStatsFormat()
+
+    negative_control = "%s" % os.path.abspath(str(negative_control))
+
+    #only the negative control columns are read, a block at a time
+    means = _streaming_negative_means(
+        negative_control, negative_control, negative_id, negative_names,
+        max_memory
+    )
+    means.name = "Negative control mean"
+    _write_scores(means.to_frame(), str(stats_output))
+
+    return stats_output
+
+# Name: norm_size_factors_reference
+# Process: collects the per peptide geometric means used as the size factors
+# reference, so new samples can be normalized against it later
+# Method inputs/parameters: peptide_scores, max_memory
+# Method outputs/Returned: the size factors reference tsv
+# Dependencies: os
+def norm_size_factors_reference(
+        peptide_scores: PepsirfContingencyTSVFormat,
+        max_memory: int = 1024) -> SizeFactorsReferenceFormat:
+
+    reference_output = SizeFactorsReferenceFormat()
+
+    peptide_scores = "%s" % os.path.abspath(str(peptide_scores))
+    header = _read_header(peptide_scores)
+
+    geo_means = _streaming_geo_means(
+        peptide_scores, _block_size(max_memory, len(header) - 1)
+    )
+    geo_means.name = "Geometric mean"
+    _write_scores(geo_means.to_frame(), str(reference_output))
+
+    return reference_output
+
+# Name: norm_size_factors_append
+# Process: normalizes new samples with the size factors method against a
+# stored reference and appends them to an existing size factors table, the
+# existing rows are copied as they are, every peptide of the new samples
+# must be in the reference and in the existing table
+# Method inputs/parameters: peptide_scores, reference, normed_scores,
+# precision
+# Method outputs/Returned: the appended norm output tsv
+# Dependencies: numpy, pandas
+def norm_size_factors_append(
+        peptide_scores: PepsirfContingencyTSVFormat,
+        reference: SizeFactorsReferenceFormat,
+        normed_scores: PepsirfContingencyTSVFormat,
+        precision: int = 2) -> PepsirfContingencyTSVFormat:
+
+    tsv_output = PepsirfContingencyTSVFormat()
+
+    scores = _read_scores(str(peptide_scores))
+    normed_header = _read_header(str(normed_scores))
+
+    duplicates = set(normed_header[1:]).intersection(scores.columns)
+    if duplicates:
+        raise ValueError(
+            "Samples already in the normalized table: %s"
+            % ", ".join(sorted(duplicates))
         )
 
-        #check if optional parameters are inputted and add to command
-        if negative_control:
-            cmd += " --negative_control %s" % str(negative_control)
-        if negative_id:
-            cmd += " -s %s" % negative_id
-        if negative_names:
-            cmd += " -n %s" % ",".join(negative_names)
+    #the new scores of peptides missing from the reference or the existing
+    #table could not be normalized or appended
+    geo_means = _read_scores(str(reference)).iloc[:, 0]
+    normed_peptides = pd.read_csv(
+        str(normed_scores), sep="\t", usecols=[0],
+        dtype={normed_header[0]: str}
+    ).iloc[:, 0]
+    for name, peptides in (
+            ("size factors reference", geo_means.index),
+            ("normalized table", normed_peptides)):
+        missing = scores.index.difference(peptides)
+        if len(missing):
+            raise ValueError(
+                "%d peptides of the new samples are not in the %s: %s"
+                % (len(missing), name, ", ".join(missing[:10]))
+            )
 
-    #add outfile to command
-    cmd += " >> %s" % outfile
+    geo_means = geo_means.reindex(scores.index).to_numpy()
 
-    #run command in the command line
-    subprocess.run(cmd, shell=True, check=True)
+    values = scores.to_numpy(dtype=float)
+    normed = _normalize_values(
+        values, "size_factors", _size_factors(values, geo_means)
+    )
+
+    #format the new columns once for each peptide
+    formatted = np.char.mod(_float_format(precision), normed)
+    appended = {
+        peptide: "\t" + "\t".join(row)
+        for peptide, row in zip(scores.index, formatted)
+    }
+    _append_columns(
+        str(normed_scores), list(scores.columns), appended, str(tsv_output)
+    )
 
-    #return norm output
     return tsv_output
- 
+
+# Name: norm_sparse
+# Process: normalizes a feature table in process on its sparse matrix
+# Method inputs/parameters: peptide_scores, normalize_approach, precision
+# Method outputs/Returned: the normalized biom table
+# Dependencies: biom, numpy, scipy
+def norm_sparse(
+        peptide_scores: biom.Table,
+        normalize_approach: str = "col_sum",
+        precision: int = 2) -> biom.Table:
+
+    return _norm_sparse_table(peptide_scores, normalize_approach, precision)
@@ -1,24 +1,345 @@
+from concurrent.futures import ThreadPoolExecutor
+from q2_pepsirf.actions._utils import (
+    _append_columns, _load_bin_index, _read_header, _read_scores,
+    _resolve_num_threads, _select_columns, _write_bin_lines, _write_scores
+)
 from q2_pepsirf.format_types import (
-    PepsirfContingencyTSVFormat, PeptideBinFormat, ZscoreNan, ZscoreNanFormat
+    PepsirfContingencyTSVFormat, PeptideBinIndexFormat, ZscoreBinStatsFormat,
+    ZscoreNan, ZscoreNanFormat
 )
 
+import numpy as np
 import os
+import pandas as pd
 import qiime2
 import subprocess
 import tempfile
 
+# Name: _bin_members
+# Process: maps every peptide of the score matrix to the index of its bin
+# and groups the peptide rows by bin
+# Method inputs/parameters: peptides, bin_index
+# Method outputs/Returned: the bin index of each peptide (-1 if not binned),
+# the peptide rows sorted by bin and the offset of each bin in those rows
+# Dependencies: numpy, pandas
+def _bin_members(peptides, bin_index):
+    names, bins, offsets, _ = bin_index
+
+    #look every peptide up in the interned names at once
+    positions = pd.Index(names).get_indexer(peptides)
+
+    #only found peptides index bins, which may be empty
+    binned = positions >= 0
+    bin_of = np.full(len(positions), -1, dtype=np.int64)
+    bin_of[binned] = bins[positions[binned]]
+
+    #a stable sort keeps each bin in score matrix order
+    order = np.argsort(bin_of, kind="stable")
+    order = order[bin_of[order] >= 0]
+    counts = np.bincount(bin_of[order], minlength=len(offsets) - 1)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    return bin_of, order, offsets
+
+# Name: _sorted_scores
+# Process: sorts the scores of every sample of a group of equally sized bins
+# and counts the scores that are not nan, nan scores are sorted last and
+# are left out of the statistics of both the trim and the hdi method
+# Method inputs/parameters: values
+# Method outputs/Returned: the sorted scores and the per bin and sample
+# number of scores that are not nan
+# Dependencies: numpy
+def _sorted_scores(values):
+    values = np.sort(values, axis=1)
+    return values, (~np.isnan(values)).sum(axis=1)
+
+# Name: _window_stats
+# Process: calculates the mean and standard deviation of a window of sorted
+# scores for every bin and sample, windows may differ in start and width
+# Method inputs/parameters: values, start, width
+# Method outputs/Returned: the per bin and sample means and standard
+# deviations, nan for empty windows
+# Dependencies: numpy
+def _window_stats(values, start, width):
+    position = np.arange(values.shape[1])[:, np.newaxis]
+    inside = (
+        (position >= start[:, np.newaxis])
+        & (position < (start + width)[:, np.newaxis])
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(inside, values, 0.0).sum(axis=1) / width
+        deviations = np.where(inside, values - means[:, np.newaxis], 0.0)
+        stdevs = np.sqrt((deviations ** 2).sum(axis=1) / width)
+
+    means[width == 0] = np.nan
+    stdevs[width == 0] = np.nan
+    return means, stdevs
+
+# Name: _trimmed_stats
+# Process: calculates the trimmed mean and standard deviation of every
+# sample of a group of equally sized bins at once, trimming the given
+# percent of the scores that are not nan from each end of each sorted bin
+# Method inputs/parameters: values, trim
+# Method outputs/Returned: the per bin and sample means, standard
+# deviations and numbers of scores kept
+# Dependencies: numpy
+def _trimmed_stats(values, trim):
+    values, counts = _sorted_scores(values)
+    cut = (counts * trim / 100).astype(np.int64)
+    cut[counts - 2 * cut < 1] = 0
+
+    width = counts - 2 * cut
+    means, stdevs = _window_stats(values, cut, width)
+    return means, stdevs, width
+
+# Name: _hdi_stats
+# Process: calculates the mean and standard deviation of the highest density
+# interval of every sample of a group of equally sized bins at once, the
+# narrowest window of sorted scores covering the hdi proportion of the
+# scores that are not nan
+# Method inputs/parameters: values, hdi
+# Method outputs/Returned: the per bin and sample means, standard
+# deviations and numbers of scores kept
+# Dependencies: numpy
+def _hdi_stats(values, hdi):
+    values, counts = _sorted_scores(values)
+    width = np.minimum(
+        counts, np.maximum(1, np.ceil(counts * hdi).astype(np.int64))
+    )
+
+    #compare every window of each sample's width that has no nan score
+    start = np.arange(values.shape[1])[:, np.newaxis]
+    end = start + width[:, np.newaxis] - 1
+    ends = np.take_along_axis(
+        values, np.clip(end, 0, values.shape[1] - 1), axis=1
+    )
+    spans = np.where(end < counts[:, np.newaxis], ends - values, np.inf)
+    start = np.argmin(spans, axis=1)
+
+    means, stdevs = _window_stats(values, start, width)
+    return means, stdevs, width
+
+# Name: _bin_stats_block
+# Process: calculates the statistics of every bin for a block of samples,
+# the bins of each size are gathered and calculated together
+# Method inputs/parameters: values, order, offsets, trim, hdi
+# Method outputs/Returned: the per bin and sample means, standard
+# deviations and numbers of scores kept
+# Dependencies: numpy
+def _bin_stats_block(values, order, offsets, trim, hdi):
+    means = np.full((len(offsets) - 1, values.shape[1]), np.nan)
+    stdevs = np.full((len(offsets) - 1, values.shape[1]), np.nan)
+    kept = np.zeros((len(offsets) - 1, values.shape[1]), dtype=np.int64)
+
+    sizes = np.diff(offsets)
+    for size in np.unique(sizes[sizes > 0]):
+        bin_numbers = np.flatnonzero(sizes == size)
+        #bins by members by samples
+        members = order[
+            offsets[bin_numbers][:, np.newaxis] + np.arange(size)
+        ]
+
+        #hdi overrides trim when it is provided
+        if hdi > 0:
+            stats = _hdi_stats(values[members], hdi)
+        else:
+            stats = _trimmed_stats(values[members], trim)
+        means[bin_numbers], stdevs[bin_numbers], kept[bin_numbers] = stats
+
+    return means, stdevs, kept
+
+# Name: _bin_stats
+# Process: calculates the statistics of every bin for all samples,
+# splitting the samples into blocks run on num_threads threads
+# Method inputs/parameters: values, order, offsets, trim, hdi, num_threads
+# Method outputs/Returned: the per bin and sample means, standard
+# deviations and numbers of scores kept
+# Dependencies: numpy, concurrent.futures
+def _bin_stats(values, order, offsets, trim, hdi, num_threads):
+    #samples are independent and numpy sorts release the gil
+    blocks = [
+        block for block in np.array_split(
+            np.arange(values.shape[1]), max(1, num_threads)
+        )
+        if len(block)
+    ]
+    if not blocks:
+        return _bin_stats_block(values, order, offsets, trim, hdi)
+
+    with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+        results = list(executor.map(
+            lambda block: _bin_stats_block(
+                values[:, block], order, offsets, trim, hdi
+            ),
+            blocks
+        ))
+
+    means = np.hstack([means for means, _, _ in results])
+    stdevs = np.hstack([stdevs for _, stdevs, _ in results])
+    kept = np.hstack([kept for _, _, kept in results])
+    return means, stdevs, kept
+
+# Name: _write_nan_report
+# Process: writes the peptide, sample and bin of every nan z score
+# Method inputs/parameters: zscores, bin_of, peptides, samples, path
+# Method outputs/Returned: None
+# Dependencies: numpy
+def _write_nan_report(zscores, bin_of, peptides, samples, path):
+    rows, columns = np.nonzero(np.isnan(zscores) & (bin_of >= 0)[:, None])
+
+    with open(path, "w") as fh:
+        fh.write("Probe name\tSample name\tBin number\n")
+        fh.writelines(
+            "%s\t%s\t%d\n" % (peptides[row], samples[column], bin_of[row])
+            for row, column in zip(rows, columns)
+        )
+
+# Name: _zscore_numpy
+# Process: calculates the z scores of every peptide in every sample in
+# process from the statistics of its bin, the bins are read from their
+# index without parsing the bins text
+# Method inputs/parameters: scores, bins, trim, hdi, num_threads,
+# zscore_output, nan_report
+# Method outputs/Returned: None
+# Dependencies: numpy, pandas
+def _zscore_numpy(
+        scores, bins, trim, hdi, num_threads, zscore_output, nan_report):
+
+    scores = _read_scores(scores)
+    values = scores.to_numpy(dtype=float)
+    bin_of, order, offsets = _bin_members(scores.index, _load_bin_index(bins))
+    means, stdevs, _ = _bin_stats(
+        values, order, offsets, trim, hdi, num_threads
+    )
+
+    #peptides that are not in any bin are given a nan z score
+    zscores = np.full(values.shape, np.nan)
+    binned = bin_of >= 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zscores[binned] = (
+            (values[binned] - means[bin_of[binned]]) / stdevs[bin_of[binned]]
+        )
+
+    _write_scores(
+        pd.DataFrame(zscores, index=scores.index, columns=scores.columns),
+        zscore_output
+    )
+    _write_nan_report(
+        zscores, bin_of, scores.index, scores.columns, nan_report
+    )
+
+# Name: _run_zscore
+# Process: calculates the z scores of a score matrix file into output files
+# with the chosen engine, pepsirf is given the bins of the index as a bins
+# file
+# Method inputs/parameters: scores, bins, trim, hdi, num_threads, engine,
+# zscore_output, nan_report, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: os, subprocess, tempfile
+def _run_zscore(
+        scores, bins, trim, hdi, num_threads, engine, zscore_output,
+        nan_report, outfile, pepsirf_binary):
+
+    #calculate the z scores in process without starting pepsirf
+    if engine == "numpy":
+        _zscore_numpy(
+            scores, bins, trim, hdi, num_threads, zscore_output, nan_report
+        )
+        return
+
+    #open temp file to work in
+    with tempfile.TemporaryDirectory() as tempdir:
+        #pepsirf reads the bins as one tab-delimited line per bin
+        bins_file = os.path.join(tempdir, "bins.tsv")
+        names, _, offsets, members = _load_bin_index(bins)
+        _write_bin_lines(names, offsets, members, bins_file)
+
+        #collect command line
+        cmd = (
+            "%s zscore -s %s -b %s -t %s"
+            " -d %s -o %s -n %s --num_threads %s"
+            % (
+                pepsirf_binary, scores, bins_file, str(trim),
+                str(hdi), zscore_output, nan_report, str(num_threads)
+            )
+        )
+
+        #add outfile to end of command
+        cmd += " >> %s" % outfile
+
+        #run the collected command
+        subprocess.run(cmd, shell=True, check=True)
+
+# Name: _zscore_new_samples
+# Process: calculates the z scores of only the samples missing from an
+# existing z score matrix and merges them with the existing outputs
+# Method inputs/parameters: scores, bins, existing_zscores,
+# existing_nan_report, trim, hdi, num_threads, engine, zscore_output,
+# nan_report, outfile, pepsirf_binary
+# Method outputs/Returned: None
+# Dependencies: os, tempfile
+def _zscore_new_samples(
+        scores, bins, existing_zscores, existing_nan_report, trim, hdi,
+        num_threads, engine, zscore_output, nan_report, outfile,
+        pepsirf_binary):
+
+    #z scores only depend on the bins and the sample itself
+    existing = set(_read_header(existing_zscores)[1:])
+    positions = [
+        position
+        for position, sample in enumerate(_read_header(scores))
+        if position > 0 and sample not in existing
+    ]
+
+    samples = []
+    rows = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        new_nan_report = os.path.join(tempdir, "nan-zscores.nan")
+
+        if positions:
+            new_scores = os.path.join(tempdir, "scores.tsv")
+            new_zscores = os.path.join(tempdir, "zscores.tsv")
+            _select_columns(scores, positions, new_scores)
+            _run_zscore(
+                new_scores, bins, trim, hdi, num_threads, engine,
+                new_zscores, new_nan_report, outfile, pepsirf_binary
+            )
+
+            with open(new_zscores) as fh:
+                samples = fh.readline().rstrip("\r\n").split("\t")[1:]
+                for line in fh:
+                    peptide, _, zscores = line.rstrip("\r\n").partition("\t")
+                    rows[peptide] = "\t" + zscores
+
+        _append_columns(existing_zscores, samples, rows, zscore_output)
+
+        #the existing nan report is kept and the new entries follow it
+        with open(nan_report, "w") as fh:
+            with open(existing_nan_report) as in_fh:
+                for line in in_fh:
+                    fh.write(line.rstrip("\r\n") + "\n")
+            if positions:
+                with open(new_nan_report) as in_fh:
+                    next(in_fh)
+                    for line in in_fh:
+                        fh.write(line.rstrip("\r\n") + "\n")
+
 # Name: zsore
 # Process: runs pepsirf's zscore module
-# Method inputs/parameters: scores, bins, trim, hdi, num_threads,
-#  outfile, pepsirf_binary
+# Method inputs/parameters: scores, bins, trim, hdi, num_threads, engine,
+# existing_zscores, existing_nan_report, outfile, pepsirf_binary
 # Method outputs/Returned: the zscore output tsv and nan report
-# Dependencies: subprocess, os, tempfile
+# Dependencies: os
 def zscore(
         scores: PepsirfContingencyTSVFormat,
-        bins: PeptideBinFormat,
+        bins: PeptideBinIndexFormat,
         trim: float = 2.5,
         hdi: float = 0.0,
         num_threads: int = 2,
+        engine: str = "pepsirf",
+        existing_zscores: PepsirfContingencyTSVFormat = None,
+        existing_nan_report: ZscoreNanFormat = None,
         outfile: str = "./zscore.out",
         pepsirf_binary: str = "pepsirf"
     ) -> (PepsirfContingencyTSVFormat, ZscoreNanFormat):
@@ -27,6 +348,8 @@ def zscore(
     zscore_output = PepsirfContingencyTSVFormat()
     nan_report = ZscoreNanFormat()
 
+    num_threads = _resolve_num_threads(num_threads)
+
     #collect absolute file path names for inputs
     scores = "%s" % os.path.abspath(str(scores))
     bins = "%s" % os.path.abspath(str(bins))
@@ -35,24 +358,56 @@ def zscore(
     if os.path.isfile(pepsirf_binary):
         pepsirf_binary = "%s" % os.path.abspath(pepsirf_binary)
 
-    #open temp file to work in
-    with tempfile.TemporaryDirectory() as tempdir: 
-        #collect command line
-        cmd = (
-            "%s zscore -s %s -b %s -t %s"
-            " -d %s -o %s -n %s --num_threads %s"
-            % (
-                pepsirf_binary, str(scores), str(bins), str(trim),
-                str(hdi), str(zscore_output), str(nan_report), str(num_threads)
+    #only score the samples that are not already in the existing outputs
+    if existing_zscores or existing_nan_report:
+        if not (existing_zscores and existing_nan_report):
+            raise ValueError(
+                "existing_zscores and existing_nan_report must be provided"
+                " together."
             )
+
+        _zscore_new_samples(
+            scores, bins, str(existing_zscores), str(existing_nan_report),
+            trim, hdi, num_threads, engine, str(zscore_output),
+            str(nan_report), outfile, pepsirf_binary
+        )
+    else:
+        _run_zscore(
+            scores, bins, trim, hdi, num_threads, engine, str(zscore_output),
+            str(nan_report), outfile, pepsirf_binary
         )
 
-        #add outfile to end of command
-        cmd += " >> %s" % outfile
+    #return the zscore outputs as qza's
+    return (zscore_output, nan_report)
 
-        #run the collected command
-        subprocess.run(cmd, shell=True, check=True)
+# Name: zscore_bin_stats
+# Process: calculates the trimmed (or hdi) mean, standard deviation and
+# member count of every bin in every sample and stores them compactly
+# Method inputs/parameters: scores, bins, trim, hdi, num_threads
+# Method outputs/Returned: the bin statistics npz
+# Dependencies: numpy
+def zscore_bin_stats(
+        scores: PepsirfContingencyTSVFormat,
+        bins: PeptideBinIndexFormat,
+        trim: float = 2.5,
+        hdi: float = 0.0,
+        num_threads: int = 2
+    ) -> ZscoreBinStatsFormat:
+
+    bin_stats = ZscoreBinStatsFormat()
+    num_threads = _resolve_num_threads(num_threads)
 
-        #return the zscore outputs as qza's
-        return (zscore_output, nan_report)
+    scores = _read_scores(str(scores))
+    values = scores.to_numpy(dtype=float)
+    _, order, offsets = _bin_members(scores.index, _load_bin_index(str(bins)))
+    means, stdevs, kept = _bin_stats(
+        values, order, offsets, trim, hdi, num_threads
+    )
+
+    with bin_stats.open() as fh:
+        np.savez_compressed(
+            fh, samples=np.asarray(scores.columns, dtype=str), mean=means,
+            stdev=stdevs, members=np.diff(offsets), kept=kept
+        )
 
+    return bin_stats
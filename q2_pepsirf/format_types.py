@@ -1,9 +1,12 @@
 #!/usr/bin/env python
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from q2_types.feature_table import FeatureTable
 from qiime2.plugin import SemanticType
 
 import os
 import qiime2.plugin.model as model
+import zipfile
 
 # create a semantic type for each format type created
 Normed = SemanticType("Normed", variant_of=FeatureTable.field["content"])
@@ -49,6 +52,11 @@ DemuxFastq = SemanticType("DemuxFastq")
 DemuxDiagnostic = SemanticType("DemuxDiagnostic")
 ProteinAlignment = SemanticType("ProteinAlignment")
 MutantReference = SemanticType("MutantReference")
+NegativeControlStats = SemanticType("NegativeControlStats")
+SizeFactorsReference = SemanticType("SizeFactorsReference")
+ZscoreBinStats = SemanticType("ZscoreBinStats")
+BinSweepSummary = SemanticType("BinSweepSummary")
+EnrichSweepCounts = SemanticType("EnrichSweepCounts")
 
 # create a format for a featuretable file
 class PepsirfContingencyTSVFormat(model.TextFileFormat):
@@ -77,15 +85,147 @@ class PeptideIDListFmt(model.TextFileFormat):
                 )
 
 
+# stands in for the format of a collection while its directory is
+# validated, so each member is recorded to be validated later instead of
+# being validated in turn
+class _DeferredMemberFormat:
+    def __init__(self, format, pending):
+        self.format = format
+        self.pending = pending
+
+    def __call__(self, path, mode="r"):
+        return _DeferredMember(self.format, path, self.pending)
+
+
+class _DeferredMember:
+    def __init__(self, format, path, pending):
+        self.format = format
+        self.path = path
+        self.pending = pending
+
+    def validate(self, level="max"):
+        self.pending.append((self.format, self.path, level))
+
+
+# a file collection whose members can be validated after the structure of
+# their directory, see ParallelCollectionValidation
+class ParallelFileCollection(model.FileCollection):
+    def __get__(self, obj, cls=None):
+        bound = super().__get__(obj, cls)
+        pending = getattr(obj, "_pending_members", None)
+        if pending is not None:
+            bound.format = _DeferredMemberFormat(self.format, pending)
+        return bound
+
+
+# mixin for directory formats with many files in a collection, the
+# directory is validated by qiime2's DirectoryFormat and only the members of
+# its ParallelFileCollections are then validated on a bounded pool of
+# threads, so that only a few files are open at a time
+class ParallelCollectionValidation:
+    validation_workers = 8
+
+    # Name: _manifest_checks
+    # Process: collects cheaper checks that replace the format validation of
+    # collection members, for formats that keep a manifest of their files
+    # Method inputs/parameters: members, level
+    # Method outputs/Returned: the check of each relative path to replace
+    # Dependencies: None
+    def _manifest_checks(self, members, level):
+        return {}
+
+    # Name: validate
+    # Process: validates the structure of the directory with
+    # DirectoryFormat.validate while collecting the collection members, then
+    # validates the members, or runs their manifest checks, concurrently
+    # Method inputs/parameters: level
+    # Method outputs/Returned: None
+    # Dependencies: concurrent.futures
+    def validate(self, level="max"):
+        self._pending_members = []
+        try:
+            super().validate(level)
+            pending = self._pending_members
+        finally:
+            del self._pending_members
+        if not pending:
+            return
+
+        relpaths = [str(path.relative_to(self.path)) for _, path, _ in pending]
+        checks = self._manifest_checks(set(relpaths), level)
+        members = [
+            checks.get(relpath)
+            or partial(format(path, mode="r").validate, level)
+            for relpath, (format, path, level) in zip(relpaths, pending)
+        ]
+
+        workers = min(self.validation_workers, len(members))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda check: check(), members))
+
+
 # create a format for enrichment failure
 class EnrichmentFailureFmt(model.TextFileFormat):
     def _validate_( self, level="min"):
         pass
 
 
+# Name: _read_enriched_manifest
+# Process: reads the manifest of an enrichment directory, if it has one, the
+# listed files are not opened
+# Method inputs/parameters: directory, manifest
+# Method outputs/Returned: the pair, file name, peptide count, checksum and
+# byte size of every listed file, None without a manifest
+# Dependencies: os
+def _read_enriched_manifest(directory, manifest="manifest.tsv"):
+    path = os.path.join(str(directory), manifest)
+    if not os.path.exists(path):
+        return None
+
+    rows = []
+    with open(path) as fh:
+        next(fh, None)
+        for line in fh:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) != 5:
+                raise ValueError(
+                    "Manifest line does not have 5 fields: %r" % line
+                )
+            pair, name, count, checksum, size = fields
+            rows.append((pair, name, int(count), checksum, int(size)))
+
+    return rows
+
+
+# Name: _check_manifest_size
+# Process: checks that a file still has the byte size of its manifest entry
+# Method inputs/parameters: path, size
+# Method outputs/Returned: None
+# Dependencies: os
+def _check_manifest_size(path, size):
+    if os.path.getsize(str(path)) != size:
+        raise model.ValidationError(
+            "%s does not have the size listed in the manifest." % path.name
+        )
+
+
+# create a format for an enrichment directory manifest
+class EnrichedManifestFmt(model.TextFileFormat):
+    def _validate_(self, level="min"):
+        with self.open() as fh:
+            for _, line in zip(range(1), fh):
+                if not line.startswith(
+                        "Pair\tFile\tPeptides\tChecksum\tBytes"):
+                    raise model.ValidationError(
+                        'TSV does not start with "Pair", "File", "Peptides",'
+                        ' "Checksum" and "Bytes"'
+                    )
+
+
 # create a format for enrichment directory
-class EnrichedPeptideDirFmt(model.DirectoryFormat):
-    pairwise = model.FileCollection(
+class EnrichedPeptideDirFmt(
+        ParallelCollectionValidation, model.DirectoryFormat):
+    pairwise = ParallelFileCollection(
         r".+_+.+\.txt",
         format=PeptideIDListFmt
     )
@@ -98,6 +238,66 @@ class EnrichedPeptideDirFmt(model.DirectoryFormat):
         format=EnrichmentFailureFmt
     )
 
+    manifest = model.File(
+        "manifest.tsv",
+        format=EnrichedManifestFmt,
+        optional=True
+    )
+
+    # Name: _manifest_checks
+    # Process: trusts the enriched peptide files listed in the manifest as
+    # long as their byte size still matches, which only needs a stat instead
+    # of opening the file, the artifact's own checksums cover its contents
+    # Method inputs/parameters: members, level
+    # Method outputs/Returned: the size check of each listed file
+    # Dependencies: os
+    def _manifest_checks(self, members, level):
+        try:
+            rows = _read_enriched_manifest(self.path)
+        except ValueError as e:
+            raise model.ValidationError(str(e))
+        if rows is None:
+            return {}
+
+        checks = {}
+        for _, name, _, _, size in rows:
+            if name not in members:
+                raise model.ValidationError(
+                    "Manifest lists a missing file: %s" % name
+                )
+            checks[name] = partial(
+                _check_manifest_size, self.path / name, size
+            )
+
+        return checks
+
+
+# base format for numpy .npz archives, an archive is valid if it holds at
+# least the arrays named by the class
+class _NpzArchiveFormat(model.BinaryFileFormat):
+    arrays = set()
+
+    def _validate_(self, level="min"):
+        try:
+            with zipfile.ZipFile(str(self)) as archive:
+                names = {name[:-len(".npy")] for name in archive.namelist()}
+        except zipfile.BadZipFile:
+            raise model.ValidationError("Not a .npz archive.")
+
+        if not self.arrays.issubset(names):
+            raise model.ValidationError(
+                ".npz archive is missing the arrays: %s"
+                % ", ".join(sorted(self.arrays - names))
+            )
+
+
+# create a format for a sparse enrichment file, a numpy .npz archive of the
+# peptide and pair file names and the enriched peptides of each pair, it is
+# a conversion utility only, PairwiseEnrichment is stored as the per pair
+# EnrichedPeptideDirFmt and this view is built by reading every pair file
+class EnrichedPeptideSparseFormat(_NpzArchiveFormat):
+    arrays = {"peptides", "files", "indices", "indptr", "failures"}
+
 
 PeptideIDListDirFmt = model.SingleFileDirectoryFormat(
     "PeptideIDListDirFmt", "samp_A~samp_B.txt",
@@ -123,6 +323,18 @@ ZscoreNanDirFmt = model.SingleFileDirectoryFormat(
 )
 
 
+# create a format for a compressed nan report, a numpy .npz archive of the
+# probe and sample names and the probe, sample and bin index of each nan
+class ZscoreNanSparseFormat(_NpzArchiveFormat):
+    arrays = {"probes", "samples", "probe", "sample", "bin"}
+
+
+ZscoreNanSparseDirFmt = model.SingleFileDirectoryFormat(
+    "ZscoreNanSparseDirFmt", "nan-zscores.npz",
+    ZscoreNanSparseFormat
+)
+
+
 # create a format for bins file
 class PeptideBinFormat(model.TextFileFormat):
     def _validate_(self, level="min"):
@@ -138,6 +350,18 @@ PeptideBinDirFmt = model.SingleFileDirectoryFormat(
 )
 
 
+# create a format for an indexed bins file, a numpy .npz archive of the
+# peptide names, the bin of each peptide and the bin members as offsets
+class PeptideBinIndexFormat(_NpzArchiveFormat):
+    arrays = {"peptides", "bin", "offsets", "members"}
+
+
+PeptideBinIndexDirFmt = model.SingleFileDirectoryFormat(
+    "PeptideBinIndexDirFmt", "bins.npz",
+    PeptideBinIndexFormat
+)
+
+
 # create a format for info num of samples, num of probes files
 class PepsirfInfoSNPNFormat(model.TextFileFormat):
     def _validate_(self, level="min"):
@@ -280,8 +504,9 @@ PepsirfDeconvSingularDirFmt = model.SingleFileDirectoryFormat(
 
 
 # create a format for a deconv batch dir
-class PepsirfDeconvBatchDirFmt(model.DirectoryFormat):
-    batch = model.FileCollection(
+class PepsirfDeconvBatchDirFmt(
+        ParallelCollectionValidation, model.DirectoryFormat):
+    batch = ParallelFileCollection(
         r".+_+.+\.txt",
         format=PepsirfDeconvSingularFormat
     )
@@ -319,8 +544,11 @@ class PeptideAssignMapFormat(model.TextFileFormat):
                     )
 
 
-class PeptideAssignMapDirFmt(model.DirectoryFormat):
-    batch = model.FileCollection(r".+_.+\.map", format=PeptideAssignMapFormat)
+class PeptideAssignMapDirFmt(
+        ParallelCollectionValidation, model.DirectoryFormat):
+    batch = ParallelFileCollection(
+        r".+_.+\.map", format=PeptideAssignMapFormat
+    )
     @batch.set_path_maker
     def batch_pathmaker(self, comparisons, suffix):
         return f'{"~".join(comparisons)}_{suffix}.map'
@@ -486,3 +714,81 @@ MutantReferenceDirFmt = model.SingleFileDirectoryFormat(
     MutantReferenceFileFmt
 )
 
+
+# create a format for a per peptide negative control statistics file
+class NegativeControlStatsFormat(model.TextFileFormat):
+    def _validate_(self, level="min"):
+        with self.open() as fh:
+            for _, line in zip(range(1), fh):
+                if not line.startswith("Sequence name\t"):
+                    raise model.ValidationError(
+                        'TSV does not start with "Sequence name"'
+                    )
+
+
+NegativeControlStatsDirFmt = model.SingleFileDirectoryFormat(
+    "NegativeControlStatsDirFmt", "negative-stats.tsv",
+    NegativeControlStatsFormat
+)
+
+
+# create a format for a size factors reference file
+class SizeFactorsReferenceFormat(model.TextFileFormat):
+    def _validate_(self, level="min"):
+        with self.open() as fh:
+            for _, line in zip(range(1), fh):
+                if not line.startswith("Sequence name\t"):
+                    raise model.ValidationError(
+                        'TSV does not start with "Sequence name"'
+                    )
+
+
+SizeFactorsReferenceDirFmt = model.SingleFileDirectoryFormat(
+    "SizeFactorsReferenceDirFmt", "size-factors-reference.tsv",
+    SizeFactorsReferenceFormat
+)
+
+
+# create a format for a per bin statistics file, a numpy .npz archive
+class ZscoreBinStatsFormat(_NpzArchiveFormat):
+    arrays = {"samples", "mean", "stdev", "members", "kept"}
+
+
+ZscoreBinStatsDirFmt = model.SingleFileDirectoryFormat(
+    "ZscoreBinStatsDirFmt", "bin-stats.npz",
+    ZscoreBinStatsFormat
+)
+
+
+# create a format for a bin sweep summary file
+class BinSweepSummaryFormat(model.TextFileFormat):
+    def _validate_(self, level="min"):
+        with self.open() as fh:
+            for _, line in zip(range(1), fh):
+                if not line.startswith("Bin size\tRound to\t"):
+                    raise model.ValidationError(
+                        'TSV does not start with "Bin size" and "Round to"'
+                    )
+
+
+BinSweepSummaryDirFmt = model.SingleFileDirectoryFormat(
+    "BinSweepSummaryDirFmt", "bin-sweep-summary.tsv",
+    BinSweepSummaryFormat
+)
+
+
+# create a format for an enrich threshold sweep counts file
+class EnrichSweepCountsFormat(model.TextFileFormat):
+    def _validate_(self, level="min"):
+        with self.open() as fh:
+            for _, line in zip(range(1), fh):
+                if not line.startswith("Sample set\t"):
+                    raise model.ValidationError(
+                        'TSV does not start with "Sample set"'
+                    )
+
+
+EnrichSweepCountsDirFmt = model.SingleFileDirectoryFormat(
+    "EnrichSweepCountsDirFmt", "enrich-sweep-counts.tsv",
+    EnrichSweepCountsFormat
+)
@@ -25,14 +25,22 @@ from q2_pepsirf.format_types import (
     ProteinAlignmentManifestFormat, ProteinAlignment,
     PeptideToProteinAlignmentFormat, ProteinAlignmentDirFormat,
     MutantReference, MutantReferenceFileFmt, MutantReferenceDirFmt,
-    ProteinAlignmentFmt
+    ProteinAlignmentFmt, NegativeControlStats, NegativeControlStatsFormat,
+    NegativeControlStatsDirFmt, SizeFactorsReference,
+    SizeFactorsReferenceFormat, SizeFactorsReferenceDirFmt, ZscoreBinStats,
+    ZscoreBinStatsFormat, ZscoreBinStatsDirFmt, ZscoreNanSparseFormat,
+    ZscoreNanSparseDirFmt, BinSweepSummary, BinSweepSummaryFormat,
+    BinSweepSummaryDirFmt, PeptideBinIndexFormat, PeptideBinIndexDirFmt,
+    EnrichedPeptideSparseFormat,
+    EnrichSweepCounts, EnrichSweepCountsFormat, EnrichSweepCountsDirFmt,
+    EnrichedManifestFmt
 )
 from qiime2.plugin import (
     Plugin, SemanticType, model,
     Int, Range, MetadataColumn,
     Categorical, Str, List,
     Visualization, Metadata, TypeMap,
-    Choices, Float, Bool
+    Choices, Float, Bool, Collection
 )
 from q2_types.feature_table import FeatureTable, BIOMV210DirFmt
 
@@ -79,13 +87,21 @@ plugin.register_formats(
     PepsirfDemuxDiagnosticFormat, PepsirfDemuxDiagnosticDirFmt,
     ProteinAlignmentManifestFormat,
     PeptideToProteinAlignmentFormat, ProteinAlignmentFmt,
-    ProteinAlignmentDirFormat, MutantReferenceFileFmt, MutantReferenceDirFmt
+    ProteinAlignmentDirFormat, MutantReferenceFileFmt, MutantReferenceDirFmt,
+    NegativeControlStatsFormat, NegativeControlStatsDirFmt,
+    SizeFactorsReferenceFormat, SizeFactorsReferenceDirFmt,
+    ZscoreBinStatsFormat, ZscoreBinStatsDirFmt, ZscoreNanSparseFormat,
+    ZscoreNanSparseDirFmt, BinSweepSummaryFormat, BinSweepSummaryDirFmt,
+    PeptideBinIndexFormat, PeptideBinIndexDirFmt,
+    EnrichedPeptideSparseFormat,
+    EnrichSweepCountsFormat, EnrichSweepCountsDirFmt, EnrichedManifestFmt
 )
 
 # register all semantic types
 plugin.register_semantic_types(
     Normed, NormedDifference, NormedDiffRatio, NormedRatio,
-    NormedSized, Zscore, RawCounts, PairwiseEnrichment
+    NormedSized, Zscore, RawCounts, PairwiseEnrichment, NegativeControlStats,
+    SizeFactorsReference, ZscoreBinStats, BinSweepSummary, EnrichSweepCounts
 )
 plugin.register_semantic_type_to_format(
     FeatureTable[
@@ -100,7 +116,7 @@ plugin.register_semantic_type_to_format(
 )
 plugin.register_semantic_type_to_format(
     ZscoreNan,
-    ZscoreNanDirFmt
+    ZscoreNanSparseDirFmt
 )
 plugin.register_semantic_type_to_format(
     PeptideBins,
@@ -190,6 +206,26 @@ plugin.register_semantic_type_to_format(
     MutantReference,
     MutantReferenceDirFmt
 )
+plugin.register_semantic_type_to_format(
+    NegativeControlStats,
+    NegativeControlStatsDirFmt
+)
+plugin.register_semantic_type_to_format(
+    SizeFactorsReference,
+    SizeFactorsReferenceDirFmt
+)
+plugin.register_semantic_type_to_format(
+    ZscoreBinStats,
+    ZscoreBinStatsDirFmt
+)
+plugin.register_semantic_type_to_format(
+    BinSweepSummary,
+    BinSweepSummaryDirFmt
+)
+plugin.register_semantic_type_to_format(
+    EnrichSweepCounts,
+    EnrichSweepCountsDirFmt
+)
 
 # create a type map to change outputs dependent on str choice
 T_approach, T_out = TypeMap ({
@@ -200,30 +236,273 @@ T_approach, T_out = TypeMap ({
     Str%Choices("size_factors"): NormedSized
 })
 
+# shared thread count parameter, "auto" uses every cpu available to the job
+num_threads_parameter = Int % Range(1, None) | Str % Choices("auto")
+
+# shared description of the "auto" thread count
+num_threads_auto_descript = (
+    " 'auto' uses the number of cpus available to the job, taking cgroup cpu"
+    " quotas and cpu affinity into account."
+)
+
+# shared parameters for norm and norm batch
+norm_shared_parameters = {
+    "normalize_approach": T_approach,
+    "negative_id": Str,
+    "negative_names": List[Str],
+    "precision": Int % Range(0, None),
+    "engine": Str % Choices("pepsirf", "numpy", "streaming"),
+    "max_memory": Int % Range(1, None),
+    "pepsirf_binary": Str,
+    "outfile": Str
+}
+
+# shared parameter descriptions for norm and norm batch
+norm_shared_parameters_descript = {
+    "normalize_approach": (
+        "'col_sum': Normalize the scores using a column-sum method. Output"
+            " per peptide is the score per million for the sample (i.e.,"
+            " summed across all peptides). "
+        "'size_factors': Normalize the scores using the size factors"
+            " method (Anders and Huber 2010). "
+        "'diff': Normalize the scores using the difference method. For"
+            " each peptide and sample, the difference between the score"
+            " and the respective peptide's mean score in the negative"
+            " controls is determined. "
+        "'ratio': Normalize the scores using the ratio method. For each"
+            " peptide and sample, the ratio of score to the respective"
+            " peptide's mean score in the negative controls is"
+            " determined. "
+        "'diff_ratio': Normalize the scores using the difference-ratio"
+            " method. For each peptide and sample, the difference between"
+            " the score and the respective peptide's mean score in the"
+            " negative controls is first determined. This difference is"
+            " then divided by the respective peptide's mean score in the"
+            " negative controls."
+    ),
+    "negative_id": "Optional approach for identifying negative controls."
+        " Provide a unique string at the start of all negative control"
+        " samples.",
+    "negative_names": "Optional approach for identifying negative"
+        " controls. Space-separated list of negative control sample"
+        " names.",
+    "precision": "Output score precision. The scores written to the output"
+        " will be output to this many decimal places.",
+    "engine": "'pepsirf': Run pepsirf's norm module. 'numpy': Normalize"
+        " the scores in process with vectorized array operations, which"
+        " avoids starting pepsirf and the extra reading and writing of the"
+        " score matrix. 'streaming': Normalize the scores in process"
+        " without loading the whole score matrix, reading and writing it"
+        " in blocks that fit within 'max_memory'.",
+    "max_memory": "Approximate memory limit, in MiB, for the 'streaming'"
+        " engine. The score matrix is read in blocks of peptides (and"
+        " blocks of samples for 'size_factors') sized to this limit.",
+    "pepsirf_binary": "The binary to call pepsirf on your system.",
+    "outfile": "The outfile that will produce a list of inputs to PepSIRF."
+}
+
+# shared input description of precomputed negative control statistics
+negative_stats_descript = (
+    "Per peptide negative control means, as output by the norm negative"
+    " stats module. If provided, these are used for the 'diff', 'ratio' and"
+    " 'diff_ratio' approaches instead of 'negative_control', 'negative_id'"
+    " and 'negative_names'."
+)
+
 # action set up for norm module
 plugin.methods.register_function(
     function=norm.norm,
     inputs={
         "peptide_scores": FeatureTable[RawCounts | Normed],
+        "negative_control": FeatureTable[RawCounts | Normed],
+        "negative_stats": NegativeControlStats
+    },
+    parameters=norm_shared_parameters,
+    outputs=[
+        ("qza_output", FeatureTable[T_out])
+    ],
+    input_descriptions={
+        "peptide_scores": "Name of FeatureTable matrix file containing peptide"
+                " scores. This file should be in the same format as the output"
+                " from the demux module.",
+        "negative_control": "Name of FeatureTable matrix file containing data"
+                " for sb samples.",
+        "negative_stats": negative_stats_descript
+    },
+    parameter_descriptions=norm_shared_parameters_descript,
+    output_descriptions={
+        "qza_output": "the FeatureTable (.qza) output based on the normalized"
+            " approach given by user"
+    },
+        name="pepsirf norm module",
+        description="Normalize raw count data with pepsirf's norm module"
+)
+
+# action set up for norm batch module
+plugin.methods.register_function(
+    function=norm.norm_batch,
+    inputs={
+        "peptide_scores": Collection[FeatureTable[RawCounts | Normed]],
+        "negative_control": FeatureTable[RawCounts | Normed],
+        "negative_stats": NegativeControlStats
+    },
+    parameters={
+        "jobs": num_threads_parameter,
+        **norm_shared_parameters
+    },
+    outputs=[
+        ("qza_output", Collection[FeatureTable[T_out]])
+    ],
+    input_descriptions={
+        "peptide_scores": "Collection of FeatureTable matrix files containing"
+            " peptide scores, for example one table per plate. Each table"
+            " is normalized on its own with the shared parameters.",
+        "negative_control": "Name of FeatureTable matrix file containing data"
+            " for sb samples, shared by every table.",
+        "negative_stats": negative_stats_descript
+    },
+    parameter_descriptions={
+        "jobs": "The number of tables to normalize at the same time, each in"
+            " its own process." + num_threads_auto_descript,
+        **norm_shared_parameters_descript
+    },
+    output_descriptions={
+        "qza_output": "Collection of normalized FeatureTables (.qza), one per"
+            " input table and with the same keys."
+    },
+    name="pepsirf norm batch module",
+    description="Normalize many raw count tables concurrently with the norm"
+        " module"
+)
+
+# action set up for norm negative stats module
+plugin.methods.register_function(
+    function=norm.norm_negative_stats,
+    inputs={
         "negative_control": FeatureTable[RawCounts | Normed]
     },
     parameters={
-        "normalize_approach": T_approach,
         "negative_id": Str,
         "negative_names": List[Str],
-        "precision": Int % Range(0, None),
-        "pepsirf_binary": Str,
-        "outfile": Str
+        "max_memory": Int % Range(1, None)
     },
     outputs=[
-        ("qza_output", FeatureTable[T_out])
+        ("negative_stats", NegativeControlStats)
     ],
     input_descriptions={
-        "peptide_scores": "Name of FeatureTable matrix file containing peptide"
-                " scores. This file should be in the same format as the output"
-                " from the demux module.",
         "negative_control": "Name of FeatureTable matrix file containing data"
-                " for sb samples."
+            " for the negative control (sb) samples."
+    },
+    parameter_descriptions={
+        "negative_id": "Optional approach for identifying negative controls."
+            " Provide a unique string at the start of all negative control"
+            " samples. All samples are used if neither this nor"
+            " 'negative_names' is provided.",
+        "negative_names": "Optional approach for identifying negative"
+            " controls. Space-separated list of negative control sample"
+            " names.",
+        "max_memory": "Approximate memory limit, in MiB, used to size the"
+            " blocks of peptides read at a time."
+    },
+    output_descriptions={
+        "negative_stats": "The mean score of each peptide across the negative"
+            " controls, which can be given to norm as 'negative_stats'."
+    },
+    name="norm negative stats module",
+    description="Precompute per peptide negative control means once for"
+        " reuse by the norm module"
+)
+
+# action set up for norm size factors reference module
+plugin.methods.register_function(
+    function=norm.norm_size_factors_reference,
+    inputs={
+        "peptide_scores": FeatureTable[RawCounts]
+    },
+    parameters={
+        "max_memory": Int % Range(1, None)
+    },
+    outputs=[
+        ("reference", SizeFactorsReference)
+    ],
+    input_descriptions={
+        "peptide_scores": "Name of FeatureTable matrix file containing the raw"
+            " peptide scores of the cohort."
+    },
+    parameter_descriptions={
+        "max_memory": "Approximate memory limit, in MiB, used to size the"
+            " blocks of peptides read at a time."
+    },
+    output_descriptions={
+        "reference": "The geometric mean score of each peptide across the"
+            " cohort, 0 for peptides with a score of zero in any sample."
+    },
+    name="norm size factors reference module",
+    description="Store the per peptide geometric means of a cohort as the"
+        " reference for normalizing new samples with the size factors method"
+)
+
+# action set up for norm size factors append module
+plugin.methods.register_function(
+    function=norm.norm_size_factors_append,
+    inputs={
+        "peptide_scores": FeatureTable[RawCounts],
+        "reference": SizeFactorsReference,
+        "normed_scores": FeatureTable[NormedSized]
+    },
+    parameters={
+        "precision": Int % Range(0, None)
+    },
+    outputs=[
+        ("qza_output", FeatureTable[NormedSized])
+    ],
+    input_descriptions={
+        "peptide_scores": "Name of FeatureTable matrix file containing the raw"
+            " peptide scores of the new samples only. Every peptide must be"
+            " in the reference and in the existing normalized table, an"
+            " error is raised otherwise.",
+        "reference": "The size factors reference of the cohort, as output by"
+            " the norm size factors reference module.",
+        "normed_scores": "The existing size factors normalized table of the"
+            " cohort. Its rows are copied to the output unchanged."
+    },
+    parameter_descriptions={
+        "precision": "Output score precision. The new scores will be output"
+            " to this many decimal places."
+    },
+    output_descriptions={
+        "qza_output": "The existing normalized table with the new samples"
+            " appended as columns. Peptides missing from the new samples are"
+            " given 'nan'."
+    },
+    name="norm size factors append module",
+    description="Normalize new samples with the size factors method against"
+        " a stored reference and append them to an existing normalized table"
+)
+
+# create a type map to change sparse outputs dependent on str choice
+T_sparse_approach, T_sparse_out = TypeMap ({
+    Str%Choices("col_sum"): Normed,
+    Str%Choices("size_factors"): NormedSized
+})
+
+# action set up for sparse norm module
+plugin.methods.register_function(
+    function=norm.norm_sparse,
+    inputs={
+        "peptide_scores": FeatureTable[RawCounts | Normed]
+    },
+    parameters={
+        "normalize_approach": T_sparse_approach,
+        "precision": Int % Range(0, None)
+    },
+    outputs=[
+        ("qza_output", FeatureTable[T_sparse_out])
+    ],
+    input_descriptions={
+        "peptide_scores": "Name of FeatureTable matrix file containing peptide"
+                " scores. The table is loaded as a sparse biom table, one"
+                " block of peptides at a time."
     },
     parameter_descriptions={
         "normalize_approach": (
@@ -231,39 +510,20 @@ plugin.methods.register_function(
                 " per peptide is the score per million for the sample (i.e.,"
                 " summed across all peptides). "
             "'size_factors': Normalize the scores using the size factors"
-                " method (Anders and Huber 2010). "
-            "'diff': Normalize the scores using the difference method. For"
-                " each peptide and sample, the difference between the score"
-                " and the respective peptide's mean score in the negative"
-                " controls is determined. "
-            "'ratio': Normalize the scores using the ratio method. For each"
-                " peptide and sample, the ratio of score to the respective"
-                " peptide's mean score in the negative controls is"
-                " determined. "
-            "'diff_ratio': Normalize the scores using the difference-ratio"
-                " method. For each peptide and sample, the difference between"
-                " the score and the respective peptide's mean score in the"
-                " negative controls is first determined. This difference is"
-                " then divided by the respective peptide's mean score in the"
-                " negative controls."
+                " method (Anders and Huber 2010). Only peptides with a"
+                " non-zero score in every sample are used to calculate the"
+                " size factors."
         ),
-        "negative_id": "Optional approach for identifying negative controls."
-            " Provide a unique string at the start of all negative control"
-            " samples.",
-        "negative_names": "Optional approach for identifying negative"
-            " controls. Space-separated list of negative control sample"
-            " names.",
         "precision": "Output score precision. The scores written to the output"
-            " will be output to this many decimal places.",
-        "pepsirf_binary": "The binary to call pepsirf on your system.",
-        "outfile": "The outfile that will produce a list of inputs to PepSIRF."
+            " will be rounded to this many decimal places."
     },
     output_descriptions={
         "qza_output": "the FeatureTable (.qza) output based on the normalized"
             " approach given by user"
     },
-        name="pepsirf norm module",
-        description="Normalize raw count data with pepsirf's norm module"
+    name="sparse norm module",
+    description="Normalize raw count data in process on the sparse matrix of"
+        " the table, without densifying it or calling pepsirf"
 )
 
 # action set up for zscore module
@@ -273,12 +533,15 @@ plugin.methods.register_function(
         "scores": FeatureTable[
             Normed | RawCounts | NormedDifference | NormedDiffRatio
         ],
-        "bins": PeptideBins
+        "bins": PeptideBins,
+        "existing_zscores": FeatureTable[Zscore],
+        "existing_nan_report": ZscoreNan
     },
     parameters={
         "trim": Float % Range(0.0, 100.0),
         "hdi": Float % Range(0.0, None),
-        "num_threads": Int % Range(1, None),
+        "num_threads": num_threads_parameter,
+        "engine": Str % Choices("pepsirf", "numpy"),
         "pepsirf_binary": Str,
         "outfile": Str
     },
@@ -292,7 +555,16 @@ plugin.methods.register_function(
             " normalized read counts can be used.",
         "bins": "Name of the file containing bins, one bin per line, as output"
             " by the bin module. Each bin contains a tab-delimited list of"
-            " peptide names."
+            " peptide names. The bins are read as an index of the peptide"
+            " names, and are only written out as text for the pepsirf"
+            " engine.",
+        "existing_zscores": "Optional z scores from a previous run with the"
+            " same bins. If provided, only the samples of 'scores' that are"
+            " missing from this table are scored and then appended to it."
+            " Must be provided together with 'existing_nan_report'.",
+        "existing_nan_report": "The nan report from the same previous run as"
+            " 'existing_zscores'. Entries for the new samples are appended"
+            " to it."
     },
     parameter_descriptions={
         "trim": "Percentile of lowest and highest counts within a bin to"
@@ -305,7 +577,15 @@ plugin.methods.register_function(
             " For example, '--hdi 0.95' would instruct the program to utilize"
             " the 95% highest density interval (from each bin) for these"
             " calculations.",
-        "num_threads": "The number of threads to use for analyses.",
+        "num_threads": "The number of threads to use for analyses."
+            + num_threads_auto_descript,
+        "engine": "'pepsirf': Run pepsirf's zscore module. 'numpy': Calculate"
+            " the z scores in process. Each peptide is mapped to its bin once"
+            " and the trimmed mean and standard deviation of a bin are"
+            " calculated for all samples at once. With 'hdi', each bin is"
+            " sorted once per sample and the narrowest window covering the"
+            " interval is found with a vectorized comparison of all windows."
+            " Blocks of samples are run on 'num_threads' threads.",
         "pepsirf_binary": "The binary to call pepsirf on your system.",
         "outfile": "The outfile that will produce a list of inputs to PepSIRF."
     },
@@ -322,12 +602,64 @@ plugin.methods.register_function(
             " second will be the name of the sample, and the third will be the"
             " bin number of the probe. This bin number corresponds to the line"
             " number in the bins file, within which the probe was found."
+            " The report is stored compressed, as a sparse table of peptide,"
+            " sample and bin indices. It can be exported as the text file"
+            " with '--output-format ZscoreNanDirFmt' and a text file can be"
+            " imported with '--input-format ZscoreNanDirFmt'."
     },
     name="pepsirf zscore module",
     description="Calculate Z scores for each peptide in each sample with"
         " pepsirf's zscore module"
 )
 
+# action set up for zscore bin stats module
+plugin.methods.register_function(
+    function=zscore.zscore_bin_stats,
+    inputs={
+        "scores": FeatureTable[
+            Normed | RawCounts | NormedDifference | NormedDiffRatio
+        ],
+        "bins": PeptideBins
+    },
+    parameters={
+        "trim": Float % Range(0.0, 100.0),
+        "hdi": Float % Range(0.0, None),
+        "num_threads": num_threads_parameter
+    },
+    outputs=[
+        ("bin_stats", ZscoreBinStats)
+    ],
+    input_descriptions={
+        "scores": "Name of the file to use as input. Should be a score matrix"
+            " in the format as output by the demux and subjoin modules. Raw or"
+            " normalized read counts can be used.",
+        "bins": "Name of the file containing bins, one bin per line, as output"
+            " by the bin module. The bins are read as an index of the peptide"
+            " names."
+    },
+    parameter_descriptions={
+        "trim": "Percentile of lowest and highest counts within a bin to"
+            " ignore when calculating the mean and standard deviation.",
+        "hdi": "Alternative approach for discarding outliers prior to"
+            " calculating mean and stdev. If provided, this argument will"
+            " override --trim and the given high density interval of each bin"
+            " is used instead.",
+        "num_threads": "The number of threads to use for analyses."
+            + num_threads_auto_descript
+    },
+    output_descriptions={
+        "bin_stats": "A compressed numpy (.npz) archive with the arrays"
+            " 'samples' (sample names), 'mean' and 'stdev' (one row per bin,"
+            " in bins file order, and one column per sample), 'members' (the"
+            " number of peptides of each bin found in the scores) and 'kept'"
+            " (the number of scores of each bin and sample used for the"
+            " statistics, nan scores are never used)."
+    },
+    name="zscore bin stats module",
+    description="Calculate and store the per bin, per sample mean and standard"
+        " deviation used for z scores, for reuse without the score matrix"
+)
+
 # action set up for enrich module
 plugin.methods.register_function(
     function=enrich.enrich,
@@ -346,6 +678,10 @@ plugin.methods.register_function(
         "pepsirf_binary": Str,
         "source": MetadataColumn[Categorical],
         "exact_cs_thresh": Str,
+        "max_pairs_per_group": Int % Range(1, None),
+        "seed": Int,
+        "engine": Str % Choices("pepsirf", "numpy"),
+        "jobs": num_threads_parameter,
         "outfile": Str
     },
     outputs=[
@@ -389,17 +725,105 @@ plugin.methods.register_function(
         "pepsirf_binary": "The binary to call pepsirf on your system.",
         "source": "Metadata file containing all sample names and their source"
             " groups. Used to create pairs tsv to run pepsirf enrich module.",
+        "max_pairs_per_group": "The maximum number of pairs to evaluate for a"
+            " source group. Groups with more pairs are evaluated for a random"
+            " sample of this many pairs. Not used with 'flex_reps'. By"
+            " default every pair is evaluated.",
+        "seed": "Seed of the random sampling of pairs for"
+            " 'max_pairs_per_group', to make the sample reproducible.",
+        "engine": "'pepsirf': Run pepsirf's enrich module. 'numpy': Find the"
+            " enriched peptides in process. Each threshold matrix is read"
+            " once and compared against its thresholds for all samples at"
+            " once, then the masks of the replicates of every sample set are"
+            " combined with vectorized boolean reductions.",
+        "jobs": "The number of shards to split the sample sets into, each"
+            " shard being evaluated at the same time in its own process and"
+            " the outputs merged." + num_threads_auto_descript,
         "outfile": "The outfile that will produce a list of inputs to PepSIRF."
     },
     output_descriptions={
         "dir_fmt_output": "Directory formatted qza containing lists of"
-            " enriched peptides"
+            " enriched peptides, one file per sample set. The artifact is"
+            " always stored as this directory. EnrichedPeptideSparseFormat"
+            " is only a conversion utility: viewing the artifact as that"
+            " single compressed peptide by pair matrix, or exporting it with"
+            " '--output-format EnrichedPeptideSparseFormat', reads every"
+            " pair file and does not change how the artifact is stored."
     },
     name="pepsirf enrich module",
     description="Determines which peptides are enriched in samples with"
         " pepsirf's enrich module"
 )
 
+# action set up for enrich sweep module
+plugin.methods.register_function(
+    function=enrich.enrich_sweep,
+    inputs={
+        "zscores": FeatureTable[Zscore],
+        "col_sum": FeatureTable[Normed],
+        "raw_scores": FeatureTable[RawCounts]
+    },
+    parameters={
+        "source": MetadataColumn[Categorical],
+        "z_thresholds": List[Str],
+        "cs_thresholds": List[Str],
+        "flex_reps": Bool,
+        "raw_constraint": Int % Range(0, None),
+        "selected_z_thresh": Str,
+        "selected_cs_thresh": Str,
+        "truncate": Bool,
+        "max_pairs_per_group": Int % Range(1, None),
+        "seed": Int
+    },
+    outputs=[
+        ("counts", EnrichSweepCounts),
+        ("dir_fmt_output", PairwiseEnrichment)
+    ],
+    input_descriptions={
+        "zscores": "FeatureTable containing z scores of the normalized read"
+            " counts.",
+        "col_sum": "FeatureTable containing the normalized read counts.",
+        "raw_scores": "This matrix must contain the raw counts for each"
+            " Peptide for every sample of interest. If included,"
+            " 'raw_constraint' must also be specified."
+    },
+    parameter_descriptions={
+        "source": "Metadata file containing all sample names and their source"
+            " groups, as for the enrich module.",
+        "z_thresholds": "The z score thresholds to evaluate. Each is a single"
+            " threshold, or a lower and higher threshold separated by a"
+            " comma, as for 'exact_z_thresh' of the enrich module.",
+        "cs_thresholds": "The col-sum thresholds to evaluate, given as for"
+            " 'z_thresholds'.",
+        "flex_reps": "Evaluate every source group as one set of replicates,"
+            " instead of every pair of samples in a source group.",
+        "raw_constraint": "The minimum total raw count across all peptides for"
+            " a sample to be included in the analysis.",
+        "selected_z_thresh": "The z score threshold to output the enriched"
+            " peptides for. By default the first of 'z_thresholds'.",
+        "selected_cs_thresh": "The col-sum threshold to output the enriched"
+            " peptides for. By default the first of 'cs_thresholds'.",
+        "truncate": "Do not include more than 3 sample names in the enriched"
+            " peptide filenames, as for the enrich module.",
+        "max_pairs_per_group": "The maximum number of pairs to evaluate for a"
+            " source group, as for the enrich module.",
+        "seed": "Seed of the random sampling of pairs for"
+            " 'max_pairs_per_group'."
+    },
+    output_descriptions={
+        "counts": "Tab-delimited table with one row per sample set and"
+            " combination of z score and col-sum thresholds, giving the"
+            " number of enriched peptides. Sample sets failing"
+            " 'raw_constraint' are not included.",
+        "dir_fmt_output": "Directory formatted qza containing lists of"
+            " enriched peptides for the selected thresholds, and the sample"
+            " sets that did not result in an enriched peptide file."
+    },
+    name="enrich sweep module",
+    description="Counts the enriched peptides of every sample set for a grid"
+        " of z score and col-sum thresholds, reading the matrices only once"
+)
+
 # action set up for infoSNPN module
 plugin.methods.register_function(
     function=info.infoSNPN,
@@ -411,6 +835,7 @@ plugin.methods.register_function(
     },
     parameters={
         "get": Str%Choices("samples", "probes"),
+        "engine": Str % Choices("pepsirf", "numpy"),
         "pepsirf_binary": Str,
         "outfile": Str
     },
@@ -423,6 +848,9 @@ plugin.methods.register_function(
     parameter_descriptions={
         "get": "Specify weather you want to collect sample names or"
             " probe/peptide names",
+        "engine": "'pepsirf': Run pepsirf's info module. 'numpy': Read the"
+            " names in process, only the header row for sample names and only"
+            " the first column of each row for probe names.",
         "pepsirf_binary": "The binary to call pepsirf on your system.",
         "outfile": "The outfile that will produce a list of inputs to PepSIRF."
     },
@@ -445,6 +873,7 @@ plugin.methods.register_function(
         ],
     },
     parameters={
+        "engine": Str % Choices("pepsirf", "numpy"),
         "pepsirf_binary": Str,
         "outfile": Str
     },
@@ -455,6 +884,9 @@ plugin.methods.register_function(
         "input": "An input score matrix to gather information from."
     },
     parameter_descriptions={
+        "engine": "'pepsirf': Run pepsirf's info module. 'numpy': Sum the"
+            " probe scores of every sample in process, in one pass over"
+            " blocks of rows of the matrix.",
         "pepsirf_binary": "The binary to call pepsirf on your system.",
         "outfile": "The outfile that will produce a list of inputs to PepSIRF."
     },
@@ -486,6 +918,8 @@ plugin.methods.register_function(
         "bin_size": Int % Range(1, None),
         "round_to": Int % Range(0, None),
         "allow_other_normalization": T_flag,
+        "engine": Str % Choices("pepsirf", "numpy"),
+        "cache_dir": Str,
         "outfile": Str
     },
     outputs=[
@@ -511,6 +945,15 @@ plugin.methods.register_function(
             " example, a rounding factor of 0 will result in rounding to the"
             " nearest integer, while a rounding factor of 1 will result in"
             " rounding to the nearest tenth.",
+        "engine": "'pepsirf': Run pepsirf's bin module. 'numpy': Bin the"
+            " peptides in process. The scores of each peptide are summed in"
+            " one vectorized pass, rounded, and sorted, then tied peptides"
+            " are packed into bins of at least 'bin_size' peptides.",
+        "cache_dir": "Directory of a cache of previous binnings, which may be"
+            " shared between users. Bins are looked up by a hash of the score"
+            " matrix contents, 'bin_size', 'round_to' and the pepsirf binary"
+            " (or binning code for the 'numpy' engine), and binning is only"
+            " run when no entry is found. By default nothing is cached.",
         "outfile": "The outfile that will produce a list of inputs to PepSIRF."
     },
     output_descriptions={
@@ -523,6 +966,48 @@ plugin.methods.register_function(
         " with pepsirf's bin module"
 )
 
+# action set up for bin sweep module
+plugin.methods.register_function(
+    function=bin.bin_sweep,
+    inputs={
+        "scores": FeatureTable[
+            Normed | NormedDifference | NormedDiffRatio | NormedRatio
+            | NormedSized
+        ]
+    },
+    parameters={
+        "bin_sizes": List[Int % Range(1, None)],
+        "round_tos": List[Int % Range(0, None)]
+    },
+    outputs=[
+        ("bin_outputs", Collection[PeptideBins]),
+        ("summary", BinSweepSummary)
+    ],
+    input_descriptions={
+        "scores": "Input tab-delimited normalized score matrix file to use for"
+            " peptide binning, as for the bin module."
+    },
+    parameter_descriptions={
+        "bin_sizes": "The minimum numbers of peptides that a bin must contain"
+            " to try. See the 'bin_size' parameter of the bin module."
+            " Repeated values are tried once.",
+        "round_tos": "The rounding factors to try. See the 'round_to'"
+            " parameter of the bin module. Repeated values are tried once."
+    },
+    output_descriptions={
+        "bin_outputs": "Collection of PeptideBins files, one for each"
+            " combination of bin size and rounding factor, keyed"
+            " '<bin_size>_<round_to>'.",
+        "summary": "Tab-delimited summary with one row per combination of"
+            " bin size and rounding factor, giving the number of bins and the"
+            " minimum, median, mean and maximum number of peptides per bin."
+    },
+    name="bin sweep module",
+    description="Creates groups of peptides with similar starting abundances"
+        " for every combination of bin sizes and rounding factors, summing"
+        " and sorting the peptide scores only once"
+)
+
 # create a typemap to choose output type based on str choice
 s_approach, s_out = TypeMap ({
     Str%Choices("raw"): RawCounts,
@@ -881,7 +1366,7 @@ plugin.methods.register_function(
     parameters={
         "seq": Str,
         "read_per_loop": Int,
-        "num_threads": Int,
+        "num_threads": num_threads_parameter,
         "phred_base": Int,
         "phred_min_score": Int,
         "sindex": Str,
@@ -944,7 +1429,8 @@ plugin.methods.register_function(
             " value will result in more memory usage by the program, but will"
             " also result in fewer disk accesses, increasing performance of"
             " the program.",
-        "num_threads": "Number of threads to use for analyses.",
+        "num_threads": "Number of threads to use for analyses."
+            + num_threads_auto_descript,
         "phred_base": "Phred base to use when parsing fastq quality scores."
             " Valid options include 33 or 64.",
         "phred_min_score": "The minimum average phred-scaled quality score for"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+from q2_pepsirf.actions.bin import _bin_numpy, _pack_bins
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# Name: _data_path
+# Process: collects the path of a test data file
+# Method inputs/parameters: name
+# Method outputs/Returned: the absolute path of the data file
+# Dependencies: os
+def _data_path(name):
+    return os.path.join(os.path.dirname(__file__), "data", name)
+
+
+class PackBinsTests(unittest.TestCase):
+    def test_groups_fill_bins(self):
+        #a bin is closed once it holds at least bin_size peptides
+        self.assertEqual(_pack_bins([2, 1, 1, 3], 3), [0, 2, 4])
+
+    def test_short_last_bin_is_merged(self):
+        self.assertEqual(_pack_bins([1, 1, 1, 1, 1], 2), [0, 2, 5])
+
+    def test_single_short_bin(self):
+        self.assertEqual(_pack_bins([1, 2], 5), [0, 2])
+
+
+class BinNumpyEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.bin_output = os.path.join(self.tempdir, "bins.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    # Name: _bins
+    # Process: bins the test scores with the numpy engine
+    # Method inputs/parameters: bin_size, round_to
+    # Method outputs/Returned: the list of peptides of every bin
+    # Dependencies: None
+    def _bins(self, bin_size, round_to):
+        _bin_numpy(
+            _data_path("bin_scores.tsv"), bin_size, round_to, self.bin_output
+        )
+        with open(self.bin_output) as fh:
+            return [line.rstrip("\n").split("\t") for line in fh]
+
+    def test_tied_peptides_share_a_bin(self):
+        #the summed scores round to 1.0, 1.0, 3.0, 3.0, 5.0 and 7.0
+        self.assertEqual(
+            self._bins(2, 1), [["p2", "p1"], ["p3", "p4"], ["p5", "p6"]]
+        )
+
+    def test_short_last_bin_is_merged(self):
+        self.assertEqual(
+            self._bins(3, 1), [["p2", "p1", "p3", "p4", "p5", "p6"]]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+from q2_pepsirf.actions.enrich import _enrich_masks, _run_enrich
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# pepsirf is not a python dependency, the comparison with its output only
+# runs where a pepsirf binary is on the path
+PEPSIRF_BINARY = shutil.which("pepsirf")
+
+# Name: _data_path
+# Process: collects the path of a test data file
+# Method inputs/parameters: name
+# Method outputs/Returned: the absolute path of the data file
+# Dependencies: os
+def _data_path(name):
+    return os.path.join(os.path.dirname(__file__), "data", name)
+
+# Name: _read_enriched
+# Process: reads the enriched peptides of every pair file in an enrich
+# output directory
+# Method inputs/parameters: directory, failures
+# Method outputs/Returned: the set of enriched peptides by file name
+# Dependencies: os
+def _read_enriched(directory, failures):
+    enriched = {}
+    for name in os.listdir(directory):
+        if name == failures:
+            continue
+        with open(os.path.join(directory, name)) as fh:
+            enriched[name] = {line.strip() for line in fh if line.strip()}
+
+    return enriched
+
+
+class EnrichNumpyEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.thresh_file = os.path.join(self.tempdir, "thresh.tsv")
+        with open(self.thresh_file, "w") as fh:
+            fh.write(
+                "%s\t10,12\n%s\t100\n"
+                % (
+                    _data_path("enrich_zscores.tsv"),
+                    _data_path("enrich_col_sums.tsv")
+                )
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    # Name: _enrich
+    # Process: runs enrich on the test data with the given engine
+    # Method inputs/parameters: engine
+    # Method outputs/Returned: the set of enriched peptides by file name
+    # Dependencies: os
+    def _enrich(self, engine):
+        output_dir = os.path.join(self.tempdir, engine)
+        os.mkdir(output_dir)
+        _run_enrich(
+            self.thresh_file, _data_path("enrich_pairs.tsv"), None, None,
+            "failedEnrichment.txt", False, "_enriched.txt", engine,
+            output_dir, os.path.join(self.tempdir, "enrich.out"),
+            PEPSIRF_BINARY
+        )
+
+        return _read_enriched(output_dir, "failedEnrichment.txt")
+
+    def test_numpy_engine_enriched_peptides(self):
+        self.assertEqual(
+            self._enrich("numpy"),
+            {
+                "S1~S2_enriched.txt": {"p1", "p4"},
+                "S2~S3_enriched.txt": {"p2"},
+                "S1~S4_enriched.txt": {"p4"}
+            }
+        )
+
+    @unittest.skipIf(PEPSIRF_BINARY is None, "pepsirf is not installed")
+    def test_numpy_engine_matches_pepsirf(self):
+        self.assertEqual(self._enrich("numpy"), self._enrich("pepsirf"))
+
+    def test_empty_thresh_file(self):
+        with open(self.thresh_file, "w") as fh:
+            fh.write("#no threshold matrices\n\n")
+
+        with self.assertRaisesRegex(ValueError, "no threshold matrices"):
+            _enrich_masks(self.thresh_file, ["S1", "S2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
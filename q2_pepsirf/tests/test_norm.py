@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+from q2_pepsirf.actions._utils import _read_scores
+from q2_pepsirf.actions.norm import _run_norm
+
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import tempfile
+import unittest
+
+# Name: _data_path
+# Process: collects the path of a test data file
+# Method inputs/parameters: name
+# Method outputs/Returned: the absolute path of the data file
+# Dependencies: os
+def _data_path(name):
+    return os.path.join(os.path.dirname(__file__), "data", name)
+
+
+class NormEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    # Name: _norm
+    # Process: normalizes the test scores with the given engine, a max memory
+    # of 0 makes the streaming engine read one peptide at a time
+    # Method inputs/parameters: normalize_approach, engine, negative_names
+    # Method outputs/Returned: the normalized score dataframe
+    # Dependencies: os
+    def _norm(self, normalize_approach, engine, negative_names=None):
+        tsv_output = os.path.join(
+            self.tempdir, "%s_%s.tsv" % (normalize_approach, engine)
+        )
+        _run_norm(
+            _data_path("norm_scores.tsv"), tsv_output, normalize_approach,
+            None, None, negative_names, None, 6, engine, 0,
+            os.path.join(self.tempdir, "norm.out"), "pepsirf"
+        )
+
+        return _read_scores(tsv_output)
+
+    def test_col_sum(self):
+        normed = self._norm("col_sum", "numpy")
+        np.testing.assert_allclose(
+            normed.loc["p1"], [100000.0, 100000.0, 1000000.0 / 9]
+        )
+
+    def test_size_factors(self):
+        #p4 has a zero score so the size factors come from p1, p2, p3 and p5
+        normed = self._norm("size_factors", "numpy")
+        np.testing.assert_allclose(normed.loc["p1"], [2000 ** (1 / 3)] * 3)
+
+    def test_diff(self):
+        normed = self._norm("diff", "numpy", ["NC1"])
+        np.testing.assert_allclose(normed.loc["p5"], [15.0, 40.0, 0.0])
+
+    def test_streaming_matches_numpy(self):
+        for normalize_approach, negative_names in (
+                ("col_sum", None), ("size_factors", None),
+                ("diff", ["NC1"]), ("ratio", ["NC1"])):
+            with self.subTest(normalize_approach=normalize_approach):
+                pd.testing.assert_frame_equal(
+                    self._norm(normalize_approach, "numpy", negative_names),
+                    self._norm(
+                        normalize_approach, "streaming", negative_names
+                    )
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
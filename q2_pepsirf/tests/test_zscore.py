@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from q2_pepsirf.actions.zscore import _bin_stats
+
+import numpy as np
+import unittest
+
+
+class BinStatsTests(unittest.TestCase):
+    def setUp(self):
+        #one bin of ten peptides, the second sample has a nan score
+        self.values = np.array([
+            [1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0], [5.0, 5.0],
+            [6.0, 6.0], [7.0, 7.0], [8.0, 8.0], [9.0, 9.0], [10.0, np.nan]
+        ])
+        self.order = np.arange(10)
+        self.offsets = np.array([0, 10])
+
+    def test_trimmed_stats(self):
+        means, stdevs, kept = _bin_stats(
+            self.values[:, :1], self.order, self.offsets, 10, 0.0, 1
+        )
+
+        #one score is trimmed from each end, leaving 2..9
+        np.testing.assert_allclose(means, [[5.5]])
+        np.testing.assert_allclose(stdevs, [[np.sqrt(5.25)]])
+        np.testing.assert_array_equal(kept, [[8]])
+
+    def test_bins_of_different_sizes(self):
+        means, stdevs, kept = _bin_stats(
+            self.values[:, :1], np.array([0, 2, 4, 1, 3, 5, 7]),
+            np.array([0, 3, 7]), 0.0, 0.0, 2
+        )
+
+        #the bins hold the scores 1, 3, 5 and 2, 4, 6, 8
+        np.testing.assert_allclose(means, [[3.0], [5.0]])
+        np.testing.assert_allclose(stdevs, [[np.sqrt(8 / 3)], [np.sqrt(5)]])
+        np.testing.assert_array_equal(kept, [[3], [4]])
+
+    def test_trim_skips_nan_scores(self):
+        means, stdevs, kept = _bin_stats(
+            self.values, self.order, self.offsets, 20, 0.0, 1
+        )
+
+        #3..8 of ten scores and 2..8 of the nine scores that are not nan
+        np.testing.assert_allclose(means, [[5.5, 5.0]])
+        np.testing.assert_allclose(stdevs, [[np.sqrt(17.5 / 6), 2.0]])
+        np.testing.assert_array_equal(kept, [[6, 7]])
+
+    def test_hdi_skips_nan_scores(self):
+        values = np.array([
+            [1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0], [10.0, 10.0],
+            [11.0, np.nan], [12.0, 11.0]
+        ])
+        means, stdevs, kept = _bin_stats(
+            values, np.arange(7), np.array([0, 7]), 0.0, 0.5, 1
+        )
+
+        #the narrowest windows are 1..4 of seven and 1..3 of six scores
+        np.testing.assert_allclose(means, [[2.5, 2.0]])
+        np.testing.assert_allclose(stdevs, [[np.sqrt(1.25), np.sqrt(2 / 3)]])
+        np.testing.assert_array_equal(kept, [[4, 3]])
+
+    def test_all_nan_sample(self):
+        values = self.values.copy()
+        values[:, 1] = np.nan
+        for trim, hdi in ((2.5, 0.0), (0.0, 0.75)):
+            means, stdevs, kept = _bin_stats(
+                values, self.order, self.offsets, trim, hdi, 2
+            )
+            self.assertTrue(np.isnan(means[0, 1]))
+            self.assertTrue(np.isnan(stdevs[0, 1]))
+            self.assertEqual(kept[0, 1], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
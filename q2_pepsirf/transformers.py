@@ -1,24 +1,30 @@
 #!/usr/bin/env python
 from q2_pepsirf.format_types import (
     PepsirfContingencyTSVFormat, PepsirfInfoSumOfProbesFmt,
-    EnrichedPeptideDirFmt, PeptideIDListFmt
+    EnrichedPeptideDirFmt, PeptideIDListFmt, ZscoreNanFormat,
+    ZscoreNanDirFmt, ZscoreNanSparseFormat, ZscoreNanSparseDirFmt,
+    PeptideBinFormat, PeptideBinIndexFormat, EnrichedPeptideSparseFormat
+)
+from q2_pepsirf.actions._utils import (
+    _enriched_dir_to_sparse, _load_bin_index, _nan_report_to_sparse,
+    _read_biom_table, _read_bin_index, _sparse_to_enriched_dir,
+    _sparse_to_nan_report, _write_bin_index, _write_bin_lines,
+    _write_biom_table, _write_enriched_manifest
 )
 from q2_pepsirf.plugin_setup import plugin
 from q2_types.feature_table import BIOMV210Format
 
-import pandas as pd
 import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse
 
 # Transform a PepsirfContingencyTSVFormat into a BIOMV210Format
 @plugin.register_transformer
 def _0(ff: PepsirfContingencyTSVFormat) -> BIOMV210Format:
     result = BIOMV210Format()
 
-    dataframe = pd.read_csv(str(ff), sep="\t", index_col=0)
-    table = biom.Table(
-        dataframe.values, observation_ids=dataframe.index,
-        sample_ids=dataframe.columns
-    )
+    table = _read_biom_table(str(ff))
 
     with result.open() as fh:
         table.to_hdf5(fh, generated_by="q2-pepsirf for pepsirf")
@@ -32,9 +38,7 @@ def _1(ff: BIOMV210Format) -> PepsirfContingencyTSVFormat:
 
     with ff.open() as fh:
         table = biom.Table.from_hdf5(fh)
-    df = table.to_dataframe(dense=True)
-    df.index.name = "Sequence name"
-    df.to_csv(str(result), sep="\t")
+    _write_biom_table(table, str(result))
 
     return result
 
@@ -44,15 +48,54 @@ def _2(ff: PepsirfInfoSumOfProbesFmt) -> pd.DataFrame:
     result = pd.read_csv(str(ff), sep="\t")
     return result
 
-# transform a EnrichedPeptideDirFmt into a pandas dataframe
+# Name: enriched_peptide_frame
+# Process: builds a boolean peptide by pair dataframe from the enriched
+# peptide files, interning each peptide once and collecting the coordinates
+# of the enriched calls, rows are the sorted peptides and columns the pairs,
+# a dense boolean dataframe can be requested for small enrichments, e.g.
+# enriched_peptide_frame(artifact.view(EnrichedPeptideDirFmt), sparse=False)
+# Method inputs/parameters: ff, sparse
+# Method outputs/Returned: the sparse boolean dataframe, or a dense boolean
+# dataframe when sparse is False
+# Dependencies: numpy, pandas, scipy
+def enriched_peptide_frame(ff, sparse=True):
+    ids = {}
+    rows = []
+    columns = []
+    pairs = []
+    for relpath, view in ff.pairwise.iter_views(PeptideIDListFmt):
+        with view.open() as fh:
+            for line in fh:
+                peptide = line.strip()
+                if peptide:
+                    rows.append(ids.setdefault(peptide, len(ids)))
+                    columns.append(len(pairs))
+        pairs.append(relpath)
+
+    #order the rows by peptide name
+    names = np.array(list(ids), dtype=object)
+    order = np.argsort(names, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    index = pd.Index(names[order])
+
+    if not sparse:
+        matrix = np.zeros((len(names), len(pairs)), dtype=bool)
+        matrix[rank[rows], columns] = True
+        return pd.DataFrame(matrix, index=index, columns=pairs)
+
+    matrix = scipy.sparse.csc_matrix(
+        (np.ones(len(rows), dtype=bool), (rank[rows], columns)),
+        shape=(len(names), len(pairs))
+    )
+    return pd.DataFrame.sparse.from_spmatrix(
+        matrix, index=index, columns=pairs
+    )
+
+# transform a EnrichedPeptideDirFmt into a sparse boolean pandas dataframe
 @plugin.register_transformer
 def _3(ff: EnrichedPeptideDirFmt ) -> pd.DataFrame:
-    pairwiseDict = {}
-    for relpath, series in ff.pairwise.iter_views(pd.Series):
-        pairwiseDict[relpath] = series
-    df = pd.DataFrame(pairwiseDict)
-    df = df.fillna(False)
-    return df
+    return enriched_peptide_frame(ff)
 
 # transform a PeptideIDListFmt into a pandas series
 @plugin.register_transformer
@@ -69,3 +112,95 @@ def _5(ff: PepsirfContingencyTSVFormat) -> pd.DataFrame:
 
     return dataframe.transpose()
 
+# transform a PepsirfContingencyTSVFormat into a sparse biom table
+@plugin.register_transformer
+def _6(ff: PepsirfContingencyTSVFormat) -> biom.Table:
+    return _read_biom_table(str(ff))
+
+# transform a biom table into a PepsirfContingencyTSVFormat
+@plugin.register_transformer
+def _7(table: biom.Table) -> PepsirfContingencyTSVFormat:
+    result = PepsirfContingencyTSVFormat()
+    _write_biom_table(table, str(result))
+    return result
+
+# transform a ZscoreNanFormat into a ZscoreNanSparseFormat
+@plugin.register_transformer
+def _8(ff: ZscoreNanFormat) -> ZscoreNanSparseFormat:
+    result = ZscoreNanSparseFormat()
+    _nan_report_to_sparse(str(ff), str(result))
+    return result
+
+# transform a ZscoreNanSparseFormat into a ZscoreNanFormat
+@plugin.register_transformer
+def _9(ff: ZscoreNanSparseFormat) -> ZscoreNanFormat:
+    result = ZscoreNanFormat()
+    _sparse_to_nan_report(str(ff), str(result))
+    return result
+
+# transform a ZscoreNanFormat into a ZscoreNanSparseDirFmt, so nan reports
+# are stored compressed
+@plugin.register_transformer
+def _10(ff: ZscoreNanFormat) -> ZscoreNanSparseDirFmt:
+    result = ZscoreNanSparseDirFmt()
+    _nan_report_to_sparse(str(ff), str(result.path / "nan-zscores.npz"))
+    return result
+
+# transform a ZscoreNanSparseDirFmt into a ZscoreNanFormat
+@plugin.register_transformer
+def _11(ff: ZscoreNanSparseDirFmt) -> ZscoreNanFormat:
+    result = ZscoreNanFormat()
+    _sparse_to_nan_report(str(ff.path / "nan-zscores.npz"), str(result))
+    return result
+
+# transform a PeptideBinFormat into a PeptideBinIndexFormat
+@plugin.register_transformer
+def _12(ff: PeptideBinFormat) -> PeptideBinIndexFormat:
+    result = PeptideBinIndexFormat()
+    _write_bin_index(*_read_bin_index(str(ff)), str(result))
+    return result
+
+# transform a PeptideBinIndexFormat into a PeptideBinFormat
+@plugin.register_transformer
+def _13(ff: PeptideBinIndexFormat) -> PeptideBinFormat:
+    result = PeptideBinFormat()
+    names, _, offsets, members = _load_bin_index(str(ff))
+    _write_bin_lines(names, offsets, members, str(result))
+    return result
+
+# transform a EnrichedPeptideDirFmt into a EnrichedPeptideSparseFormat
+@plugin.register_transformer
+def _14(ff: EnrichedPeptideDirFmt) -> EnrichedPeptideSparseFormat:
+    result = EnrichedPeptideSparseFormat()
+    _enriched_dir_to_sparse(str(ff), str(result))
+    return result
+
+# transform a EnrichedPeptideSparseFormat into a EnrichedPeptideDirFmt
+@plugin.register_transformer
+def _15(ff: EnrichedPeptideSparseFormat) -> EnrichedPeptideDirFmt:
+    result = EnrichedPeptideDirFmt()
+    _sparse_to_enriched_dir(str(ff), str(result))
+    _write_enriched_manifest(str(result))
+    return result
+
+# transform a ZscoreNanDirFmt into a ZscoreNanSparseDirFmt, for importing
+# text nan reports
+@plugin.register_transformer
+def _16(ff: ZscoreNanDirFmt) -> ZscoreNanSparseDirFmt:
+    result = ZscoreNanSparseDirFmt()
+    _nan_report_to_sparse(
+        str(ff.path / "nan-zscores.nan"),
+        str(result.path / "nan-zscores.npz")
+    )
+    return result
+
+# transform a ZscoreNanSparseDirFmt into a ZscoreNanDirFmt, for exporting
+# text nan reports
+@plugin.register_transformer
+def _17(ff: ZscoreNanSparseDirFmt) -> ZscoreNanDirFmt:
+    result = ZscoreNanDirFmt()
+    _sparse_to_nan_report(
+        str(ff.path / "nan-zscores.npz"),
+        str(result.path / "nan-zscores.nan")
+    )
+    return result
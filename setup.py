@@ -7,7 +7,7 @@ setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
     packages=find_packages(),
-    package_data={},
+    package_data={"q2_pepsirf.tests": ["data/*"]},
     author="Annabelle Brown",
     author_email="annabelle811@live.com",
     description="Qiime2 Wrapper for pepsirf",